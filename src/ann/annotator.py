@@ -35,7 +35,7 @@ def annotator():
             continue
         # Process job.
         message = receive_response["Messages"][0]
-        message_handle = message["ReceiptHandle"] # used to delete the file
+        message_handle = message["ReceiptHandle"] # used by run.py to delete the message
         body = json.loads(json.loads(message["Body"])["Message"])
 
         # Extract job parameters from the message
@@ -49,9 +49,12 @@ def annotator():
         Path("./"+job_id).mkdir(parents = True, exist_ok = True)
         s3.meta.client.download_file(input_bucket, S3_input_file,"./"+ job_id + "/" + file_name)
         
-        # Launch annotation job as a background process.
+        # Launch annotation job as a background process. It deletes the
+        # message once the job completes, and keeps it hidden until then;
+        # if this instance goes away, the message reappears and the job
+        # resumes from its checkpoint on another one.
         try:
-            subprocess.Popen(["python", "./run.py", "./" + job_id + "/" + file_name, job_id, user_email])
+            subprocess.Popen(["python", "./run.py", "./" + job_id + "/" + file_name, job_id, user_email, message_handle])
         except:
             print ("Failed to launch the annotator job for job id", job_id)
             # Delete the directory we just created.
@@ -75,12 +78,6 @@ def annotator():
             else:
                 print("Annotator updating database failed.")
                 return
-
-        # Delete the message from the queue
-        sqs.delete_message(
-                QueueUrl=config['aws']['SQSJobRequestUrl'],
-                ReceiptHandle=message_handle
-            )
             
 if __name__ == "__main__":
     annotator()
\ No newline at end of file
@@ -10,8 +10,14 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import bisect
+import threading
+
 import file_utils as fu
 import utils as u
+import intervals as iv
+import metrics as mt
+import vcfio as vio
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -33,13 +39,32 @@ def collapseGeneNames(row, indices, region, cnt):
 """"Collapces bigRefSegTable
 """
 def collapseRefSeq(line):
+    return collapseRefSeqFields(line.strip().split('\t'))
+
+
+"""Same as collapseRefSeq() for a row of values (without the leading bin
+column), without joining it into a line first
+"""
+def collapseRefSeqRow(row):
+    fields = [str(x) for x in row]
+    # strip() of the joined line drops blank values at either end
+    while ((len(fields) > 0) and (len(fields[-1].strip()) == 0)):
+        fields.pop()
+    while ((len(fields) > 0) and (len(fields[0].strip()) == 0)):
+        fields.pop(0)
+    if (len(fields) > 0):
+        fields[0] = fields[0].lstrip()
+        fields[-1] = fields[-1].rstrip()
+    return collapseRefSeqFields(fields)
+
+
+def collapseRefSeqFields(fields):
     names = ['chr', 'start', 'end', 'haplotypeReference', 
         'haplotypeAlternate', 'name', 'name2', 'transcriptStrand', 
         'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
         'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
         'changesAA', 'functionalClass','codingCoordStr','proteinCoordStr',
         'inCodingRegion', 'spliceInfo','uorfChange']
-    fields = line.strip().split('\t')
     fcount = 0
     collapsed = []
 
@@ -52,24 +77,65 @@ def collapseRefSeq(line):
     return  ';'.join(collapsed)
 
 
+"""Index of key in arg0, a sorted list of unique values; when key is not
+in it, -(i + 1), where i is the index key would be inserted at. A miss
+is then negative but still tells where key falls.
+"""
 def binarySearchUniqueAndSorted(arg0, key):
-    low = 0;
+    low = 0
     high = len(arg0) - 1
-    mid = 0;
-    obj = 0;
 
+    # [low, high] narrows on every step
     while (low <= high):
-        mid = (low + high) / 2
+        mid = (low + high) // 2
         obj = arg0[mid]
 
         if (obj < key):
-            low = mid + 1;
+            low = mid + 1
         elif (obj > key):
-            high = mid - 1;
+            high = mid - 1
         else:
-            return mid;
+            return mid
+
+    return -(low + 1) # NOT_FOUND
+
+
+"""Exon structure of a refGene transcript row, parsed once
 
-    return -1 # NOT_FOUND
+The exon bounds are kept as lists of integers. exons() finds the exons
+containing a position by binary search when the exons are in order
+with distinct starts, as they are in refGene, and by a scan otherwise.
+"""
+class Transcript(object):
+    def __init__(self, row):
+        self.exonCount = int(row[8])
+        starts = str(row[9].decode("utf-8")).split(',')
+        ends = str(row[10].decode("utf-8")).split(',')
+        self.starts = [int(starts[e]) for e in range(0, self.exonCount)]
+        self.ends = [int(ends[e]) for e in range(0, self.exonCount)]
+        self.ordered = all([(self.starts[e - 1] < self.starts[e]) and
+            (self.ends[e - 1] <= self.ends[e]) 
+            for e in range(1, self.exonCount)])
+
+    """Indices of the exons with start <= pos <= end, in exon order
+    """
+    def exons(self, pos):
+        if not self.ordered:
+            return [e for e in range(0, self.exonCount)
+                if u.isBetween(pos, self.starts[e], self.ends[e])]
+
+        # exons containing pos form a run ending at the last exon that
+        # starts at or before pos
+        hits = []
+        e = binarySearchUniqueAndSorted(self.starts, pos)
+        if (e < 0):
+            # the exon before the one pos would be inserted at
+            e = -e - 2
+        while ((e >= 0) and (self.ends[e] >= pos)):
+            hits.append(e)
+            e = e - 1
+        hits.reverse()
+        return hits
 
 
 """Cleans characters not accepted by MySQL
@@ -107,1023 +173,1278 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
-
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+"""Returns True for VCF meta-information and column header lines
+"""
+def isHeader(line):
+    return (line.startswith('#') or line.startswith('CHROM'))
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
 
-            linenum = linenum + 1
+"""A VCF data record
 
+Only the first eight columns are split. The sample columns are kept as
+one string and pass through the stages untouched. INFO is a list of
+pieces: annotations are added to it and it is joined once, when the
+record is written out (or when a stage reads the whole of INFO).
+Indexing gives the first eight columns, like the list of fields the
+stages used to get. infoMap() gives INFO parsed into its entries.
+"""
+class Record(object):
+    __slots__ = ('fields', 'info', 'samples', 'parsed')
+
+    def __init__(self, line, sep='\t'):
+        parts = line.split(sep, 8)
+        self.fields = parts[:7]
+        self.info = parts[7:8]
+        self.samples = None
+        self.parsed = None
+        if (len(parts) > 8):
+            self.samples = parts[8]
+            if (sep != '\t'):
+                self.samples = self.samples.replace(sep, '\t')
+
+    def __getitem__(self, i):
+        if (i == 7):
+            if (len(self.info) > 1):
+                self.info = [''.join(self.info)]
+            return self.info[0]
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        if (i == 7):
+            self.info = [value]
+            self.parsed = None
         else:
-            fh_out.write(line + '\n')
-
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+            self.fields[i] = value
+
+    """Copy of the first eight columns, for lookups running while the
+    record is being annotated
+    """
+    def copy(self):
+        record = Record.__new__(Record)
+        record.fields = list(self.fields)
+        record.info = list(self.info)
+        record.samples = None
+        record.parsed = None
+        return record
+
+    """INFO as a dict of each key to the list of its values, in the order
+    they appear; flags have the value None. INFO is parsed on first use
+    and again after it changes.
+    """
+    def infoMap(self):
+        if (self.parsed is None):
+            parsed = {}
+            for entry in self[7].split(';'):
+                (key, eq, value) = entry.partition('=')
+                key = key.strip()
+                if (len(key) > 0):
+                    parsed.setdefault(key, []).append(value if eq else None)
+            self.parsed = parsed
+        return self.parsed
+
+    """First value of the INFO entry key, or default when INFO has none
+    """
+    def infoValue(self, key, default='.'):
+        values = self.infoMap().get(key)
+        if values:
+            return values[0]
+        return default
+
+    """Adds text to the end of INFO as it is
+    """
+    def extendInfo(self, text):
+        self.info.append(text)
+        self.parsed = None
+
+    """Appends an annotation to INFO, adding a ';' separator unless INFO
+    already ends with one
+    """
+    def appendInfo(self, annotation):
+        last = ''
+        for piece in reversed(self.info):
+            if (len(piece) > 0):
+                last = piece
+                break
+        if not last.endswith(';'):
+            self.info.append(';')
+        self.info.append(annotation)
+        self.parsed = None
+
+    def infoStartsWith(self, prefix):
+        head = ''
+        for piece in self.info:
+            head = head + piece
+            if (len(head) >= len(prefix)):
+                break
+        return head.startswith(prefix)
+
+    """Prefixes every column but the first with a space
+    """
+    def indent(self):
+        self.fields[1:] = [' ' + f for f in self.fields[1:]]
+        self.info.insert(0, ' ')
+        self.parsed = None
+        if (self.samples is not None):
+            self.samples = ' ' + self.samples.replace('\t', '\t ')
+
+    """Strips the end of the last column, dropping columns left empty,
+    as a strip() of the written line would
+    """
+    def restrip(self):
+        if (self.samples is not None):
+            samples = self.samples.rstrip()
+            if (len(samples) > 0):
+                self.samples = samples
+                return
+            self.samples = None
+        while (len(self.info) > 0):
+            last = self.info[-1].rstrip()
+            if (last != self.info[-1]):
+                self.parsed = None
+            if (len(last) > 0):
+                self.info[-1] = last
+                return
+            self.info.pop()
+
+    def toLine(self):
+        columns = self.fields
+        if (len(self.info) > 0):
+            columns = columns + [''.join(self.info)]
+        if (self.samples is not None):
+            columns.append(self.samples)
+        return '\t'.join(columns)
+
+
+"""Base class for an annotation stage
+
+A stage annotates one VCF record at a time: lookup() queries the
+reference database, or a snapshot of it (see snapshot.py), for the
+record and apply() writes the result into the record (see Record) and
+updates the stage counters. Stages are driven either one file at a
+time (runStage) or all together in a single pass over the input (see
+pipeline.py).
+
+requires lists the stage classes whose annotations must be in a record
+before the stage looks it up; all other stages only read the CHROM,
+POS, REF and ALT columns and may be looked up concurrently.
+
+Time spent on each stage and its database queries are recorded in
+metrics (see metrics.py).
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+class Stage(object):
+    logmode = 'a'
+    echo = False
+    batch = 1
+    requires = ()
+
+    def __init__(self, table=None, format='vcf'):
+        self.table = table
+        self.format = format
+        self.inds = getFormatSpecificIndices(format=format)
+        self.counts = {}
+        self.metrics = mt.StageMetrics()
+        self.local = threading.local()
+        self.cursor = None
+        self.snapshot = None
+
+    """Lookups running on worker threads (see inflight.py) set a
+    cursor of their thread's own connection in self.local
+    """
+    @property
+    def cursor(self):
+        return getattr(self.local, 'cursor', self.sharedCursor)
+
+    @cursor.setter
+    def cursor(self, cursor):
+        self.sharedCursor = self.track(cursor)
+
+    """Cursor recording its queries in the stage metrics
+    """
+    def track(self, cursor):
+        if (cursor is None):
+            return None
+        return mt.TimedCursor(cursor, self.metrics)
+
+    """Stages read from the snapshot instead of the database when one
+    is given; conn may then be None
+    """
+    def open(self, conn, snapshot=None):
+        self.snapshot = snapshot
+        if (conn is not None):
+            self.cursor = conn.cursor()
+
+    def close(self):
+        self.cursor = None
+
+    """Called with each block of up to `batch` records before they are
+    annotated, so that a stage can resolve the whole block at once
+    """
+    def prefetch(self, block):
+        pass
+
+    """Whether lookup() may run for several records at once, in any
+    order
+    """
+    def independentLookups(self):
+        return True
+
+    def lookup(self, record):
+        return None
+
+    def apply(self, record, result):
+        pass
+
+    def annotate(self, record):
+        self.apply(record, self.lookup(record))
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    """Identifies the lookups of the stage in the variant cache (see
+    varcache.py); includes every setting that changes them
+    """
+    def cacheId(self):
+        return type(self).__name__ + ':' + str(self.table)
+
+    """The part of a lookup result that apply() needs, as stored in the
+    variant cache
+    """
+    def cacheResult(self, result):
+        return result
+
+    """Lines written to the .count.log file once the stage completes
+    """
+    def summary(self):
+        return []
+
+    """Query helpers; chromosome names with and without the "chr" prefix
+    """
+    def chrom(self, record):
+        chr = record[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def chromNoPrefix(self, record):
+        chr = record[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+        return chr
+
+    def query(self, sql):
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def queryOne(self, sql):
+        self.cursor.execute(sql)
+        return self.cursor.fetchone()
+
+    """Snapshot rows of table on chromosome chr overlapping lo..hi
+    """
+    def snapshotRows(self, table, chr, lo, hi=None):
+        return self.snapshot.table(table).find(chr, lo, hi)
+
+
+"""Base class for the stages that report "In <table>: N in M variants"
+
+Range-overlap stages find the table rows with 
+startName <= pos <= endName in one of three ways:
+  engine='sql'    one query per variant
+  engine='index'  an interval index of the table, loaded once per 
+                  chromosome
+  engine='sweep'  a merge-join of coordinate-sorted input against the 
+                  table rows streamed in start order; switches to 'index'
+                  as soon as the input turns out not to be sorted
+"""
+class OverlapStage(Stage):
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+
+    def __init__(self, table=None, format='vcf', engine='sql'):
+        Stage.__init__(self, table=table, format=format)
+        self.engine = engine
+        self.sweeper = None
+
+    def close(self):
+        if (self.sweeper is not None):
+            self.sweeper.close()
+        Stage.close(self)
+
+    # the sweep moves forward through the positions in input order
+    def independentLookups(self):
+        return (self.engine != 'sweep') or (self.snapshot is not None)
+
+    """Rows overlapping pos; with first=True only the first row, or None
+    """
+    def overlapping(self, chr, pos, first=False):
+        rows = None
+        if (self.snapshot is not None):
+            rows = []
+            if str(pos).isdigit():
+                rows = self.snapshotRows(self.table, chr, int(pos))
+        elif str(pos).isdigit():
+            if (self.engine == 'sweep'):
+                rows = self.sweep(chr, int(pos))
+            if (self.engine == 'index'):
+                rows = iv.tableIndex(self.cursor, self.table, chr, 
+                    chromName=self.chromName, startName=self.startName,
+                    endName=self.endName).find(int(pos))
+
+        if (rows is not None):
+            if first:
+                return rows[0] if (len(rows) > 0) else None
+            return rows
+
+        sql = 'select * from ' + self.table + ' where ' + self.chromName + \
+            '="' + str(chr) + '" AND (' + self.startName + ' <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= ' + self.endName + ');'
+        if first:
+            return self.queryOne(sql)
+        return self.query(sql)
+
+    def sweep(self, chr, pos):
+        if (self.sweeper is None):
+            self.sweeper = iv.TableSweep(self.table, 
+                chromName=self.chromName, startName=self.startName,
+                endName=self.endName, observe=self.metrics.query)
+        try:
+            return self.sweeper.find(chr, pos)
+        except iv.UnsortedInput:
+            self.sweeper.close()
+            self.engine = 'index'
+            return None
+
+    def summary(self):
+        return [f"In {str(self.table)}: {str(self.counts.get('var', 0))} in " + \
+            f"{str(self.counts.get('line', 0))} variants"]
+
+
+"""Runs a single stage over a whole file, reading vcf + tmpextin and
+writing vcf + tmpextout; the stage summary is added to vcf.count.log.
+The input may be gzip or BGZF compressed, the output is plain text.
+"""
+def runStage(stage, vcf, tmpextin='', tmpextout='.1', sep='\t',
+    snapshot=None):
     basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+    conn = None
+    opened = False
+    fh = None
+    fh_out = None
+    failed = True
+    try:
+        fh = vio.openInput(basefile + tmpextin)
+        fh_out = open(basefile + tmpextout, "w")
+
+        if (snapshot is None):
+            conn = u.db_pool().get()
+        stage.open(conn, snapshot=snapshot)
+        opened = True
+
+        for item in readBlocks(fh, sep=sep, size=stage.batch):
+            if isinstance(item, str):
+                fh_out.write(item + '\n')
+            else:
+                with stage.metrics.timer(records=len(item)):
+                    stage.prefetch(item)
+                    for record in item:
+                        stage.annotate(record)
+                for record in item:
+                    fh_out.write(record.toLine() + '\n')
+
+        writeSummary(stage, basefile + '.count.log')
+        failed = False
+    finally:
+        if opened:
+            stage.close()
+        # after a failure the connection may be left mid-query
+        if (conn is not None):
+            if failed:
+                u.db_pool().discard(conn)
+            else:
+                u.db_pool().put(conn)
+        if (fh is not None):
+            fh.close()
+        if (fh_out is not None):
+            fh_out.close()
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
 
+"""Reads a VCF file, yielding header lines as strings and data records,
+as Records, in blocks (lists) of up to size records
+"""
+def readBlocks(fh, sep='\t', size=1):
+    block = []
     for line in fh:
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        if isHeader(line):
+            if (len(block) > 0):
+                yield block
+                block = []
+            yield line
+        else:
+            block.append(Record(line, sep=sep))
+            if (len(block) >= size):
+                yield block
+                block = []
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+    if (len(block) > 0):
+        yield block
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+"""Column standing in for the sample columns of a record while the
+stages run one at a time (see detachSamples)
+"""
+SAMPLES_PLACEHOLDER = '.'
 
-            vcf_linenum = vcf_linenum + 1
+"""True when the records of vcf have columns after INFO (FORMAT and the
+samples), judged by the #CHROM line or else the first record
+"""
+def hasSamples(vcf, sep='\t', format='vcf'):
+    fh = vio.openInput(vcf, format=format)
+    columns = 0
+    for line in fh:
+        if not line.startswith('##'):
+            columns = len(line.strip().split(sep))
+            break
+    fh.close()
+    return (columns > 8)
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
+"""Writes vcf to dst with the sample columns of each record replaced by
+a placeholder column, and the sample columns to samplesfile, one line
+per record that has them. The stages then read and write only the
+first eight columns and the sample columns are copied once, by
+attachSamples().
+"""
+def detachSamples(vcf, dst, samplesfile, sep='\t', format='vcf'):
+    fh = vio.openInput(vcf, format=format)
+    fh_out = open(dst, 'w')
+    fh_samples = open(samplesfile, 'w')
+    for item in readBlocks(fh, sep=sep, size=1000):
+        if isinstance(item, str):
+            fh_out.write(item + '\n')
+            continue
+        for record in item:
+            if (record.samples is not None):
+                fh_samples.write(record.samples + '\n')
+                record.samples = SAMPLES_PLACEHOLDER
+            fh_out.write(record.toLine() + '\n')
     fh.close()
     fh_out.close()
+    fh_samples.close()
 
 
-"""Get information about location in gene structures
+"""Writes the annotated src to dst (as BGZF if compress) with the sample
+columns from samplesfile back in place of the placeholders, indented
+as the placeholder was (see Record.indent)
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
+def attachSamples(src, samplesfile, dst, compress=False):
+    fh = open(src)
+    fh_samples = open(samplesfile)
+    fh_out = vio.openOutput(dst, compress=compress)
     for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+        parts = line.split('\t', 8)
+        if ((len(parts) <= 8) or isHeader(line)):
+            fh_out.write(line)
+            continue
+        placeholder = parts[8].rstrip('\n')
+        samples = fh_samples.readline()
+        indents = len(placeholder) - len(SAMPLES_PLACEHOLDER)
+        if (indents > 0):
+            samples = samples.rstrip('\n')
+            for i in range(indents):
+                samples = ' ' + samples.replace('\t', '\t ')
+            samples = samples + '\n'
+        fh_out.write(line[:len(line) - len(parts[8])])
+        fh_out.write(samples)
+    fh.close()
+    fh_samples.close()
+    fh_out.close()
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+"""Writes the stage summary to the .count.log file
+"""
+def writeSummary(stage, logcountfile, mode=None):
+    lines = stage.summary()
+    if (len(lines) == 0):
+        return
+
+    fh_log = open(logcountfile, mode or stage.logmode)
+    for l in lines:
+        if stage.echo:
+            print(l)
+        fh_log.write(l + '\n')
+    fh_log.close()
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
 
+    With batch > 1 the variants are looked up a block at a time, with one
+    query per chromosome in the block instead of one query per variant.
+""" 
+class DbSnpStage(Stage):
+    logmode = 'w'
+
+    def __init__(self, table='dbSNP', format='vcf', varclass='SNV', 
+        batch=1000):
+        Stage.__init__(self, table=table, format=format)
+        self.varclass = varclass
+        self.batch = batch
+        self.prefetched = {}
+
+    def cacheId(self):
+        return Stage.cacheId(self) + ':' + self.varclass
+
+    def prefetch(self, block):
+        self.prefetched = {}
+        if ((self.batch <= 1) or (self.snapshot is not None)):
+            return
+
+        inds = self.inds
+        positions = {}
+        refs = {}
+        for record in block:
+            chr = self.chromNoPrefix(record)
+            pos = record[inds[1]].strip()
+            if not pos.isdigit():
+                continue
+            ref = clean_mysql_chars(record[inds[2]]).strip()
+            positions.setdefault(chr, set()).add(int(pos))
+            refs.setdefault(chr, set()).update([ref, getComplementary(ref)])
+
+        for chr in positions:
+            for pos in positions[chr]:
+                self.prefetched[(chr, pos)] = []
+
+            sql = 'select POS, REF, dbSNP.* from dbSNP where CHR="' + \
+                str(chr) + '" AND POS in (' + \
+                ','.join([str(x) for x in sorted(positions[chr])]) + \
+                ') AND REF in (' + \
+                ','.join(['"' + str(x) + '"' for x in sorted(refs[chr])]) + \
+                ') AND INFO = "' + self.varclass + '" ;'
+            for row in self.query(sql):
+                self.prefetched[(chr, int(row[0]))].append(row)
+
+    def lookup(self, record):
+        inds = self.inds
+        chr = self.chromNoPrefix(record)
+        pos = record[inds[1]].strip()
+        ref = clean_mysql_chars(record[inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        if (self.snapshot is not None):
+            return self.lookupSnapshot(chr, pos, [ref, compRef])
+
+        key = (chr, int(pos)) if pos.isdigit() else None
+        if (key in self.prefetched):
+            # String comparison in MySQL ignores case
+            bases = [ref.upper(), compRef.upper()]
+            return [row[2:] for row in self.prefetched[key] 
+                if str(row[1]).upper() in bases]
+
+        sql = 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            self.varclass + '" ;'
+        return self.query(sql)
+
+    def lookupSnapshot(self, chr, pos, refs):
+        if not pos.isdigit():
+            return []
+        table = self.snapshot.table(self.table)
+        iref = table.column('REF')
+        iinfo = table.column('INFO')
+        bases = [x.upper() for x in refs]
+        return [row for row in table.find(chr, int(pos))
+            if ((str(row[iref]).upper() in bases) and
+                (str(row[iinfo]).upper() == self.varclass.upper()))]
+
+    def apply(self, record, rows):
+        self.count('records')
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        record[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.count('var')
+            if (str(record[7]) == '.'):
+                record[7] = 'DB' + maf_str
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                record.extendInfo(';DB;VC=' + self.varclass + maf_str)
 
-            linenum = linenum + 1
+            record[2] = str(';'.join(rsids))
 
-        else:
-            fh_out.write(line + '\n')
+    def summary(self):
+        linenum = self.counts.get('records', 0) + 1
+        var_count = self.counts.get('var', 0)
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        return ["## Please notice that all Isoforms were counted",
+            "## Numbers may exceed number of variants in the annotated file",
+            f"Total: {str(linenum)}",
+            f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"]
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch=1000):
+    runStage(DbSnpStage(format=format, varclass=varclass, batch=batch), vcf,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+    The first table with matching rows wins. The tiers are resolved
+    with engine='sql'    up to three queries per variant
+         engine='batch'  one query per chromosome per block of variants,
+                         covering all three tables
+         engine='index'  interval indexes of the tables, loaded once per
+                         chromosome
+"""
+class BigRefGeneStage(Stage):
+    tiers = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase', 
+        'chrom_pos_unequal']
+    # column holding the end of the rows' span in each table
+    endNames = ['start', 'start', 'end']
+    # positions further apart than this are fetched as separate ranges
+    # from chrom_pos_unequal
+    spanGap = 100000
+
+    def __init__(self, table=None, format='vcf', engine='batch', 
+        batch=1000):
+        Stage.__init__(self, table=table, format=format)
+        self.engine = engine
+        self.batch = batch if (engine == 'batch') else 1
+        self.prefetched = {}
+
+    def prefetch(self, block):
+        self.prefetched = {}
+        if ((self.engine != 'batch') or (self.batch <= 1) or 
+            (self.snapshot is not None)):
+            return
+
+        positions = {}
+        for record in block:
+            pos = record[self.inds[1]].strip()
+            if pos.isdigit():
+                positions.setdefault(self.chromNoPrefix(record), 
+                    set()).add(int(pos))
+
+        for chr in positions:
+            ps = sorted(positions[chr])
+            for pos in ps:
+                self.prefetched[(chr, pos)] = ([], [], [])
+
+            inlist = ','.join([str(x) for x in ps])
+            ranges = []
+            lo = ps[0]
+            for i in range(1, len(ps) + 1):
+                if ((i == len(ps)) or (ps[i] - ps[i - 1] > self.spanGap)):
+                    ranges.append('(start <= ' + str(ps[i - 1]) + 
+                        ' AND ' + str(lo) + ' <= end)')
+                    if (i < len(ps)):
+                        lo = ps[i]
+
+            sql = ' UNION ALL '.join([
+                'select 0, ' + self.tiers[0] + '.* from ' + self.tiers[0] + 
+                ' where CHR="' + str(chr) + '" AND start in (' + inlist + ')',
+                'select 1, ' + self.tiers[1] + '.* from ' + self.tiers[1] + 
+                ' where CHR="' + str(chr) + '" AND start in (' + inlist + ')',
+                'select 2, ' + self.tiers[2] + '.* from ' + self.tiers[2] + 
+                ' where CHR="' + str(chr) + '" AND (' + ' OR '.join(ranges) + 
+                ')']) + ';'
+
+            for r in self.query(sql):
+                tier = int(r[0])
+                row = r[1:]
+                if (tier < 2):
+                    self.prefetched[(chr, int(row[2]))][tier].append(row)
+                else:
+                    first = bisect.bisect_left(ps, int(row[2]))
+                    last = bisect.bisect_right(ps, int(row[3]))
+                    for pos in ps[first:last]:
+                        self.prefetched[(chr, pos)][tier].append(row)
+
+    def lookup(self, record):
+        inds = self.inds
+        chr = self.chromNoPrefix(record)
+        pos = record[inds[1]].strip()
+        ref = clean_mysql_chars(record[inds[2]]).strip()
+        alt = clean_mysql_chars(record[inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+        alleles = [(ref, alt), (compRef, compAlt)]
+
+        if (self.snapshot is not None):
+            if not pos.isdigit():
+                return []
+            return self.resolve(int(pos), alleles, 
+                [self.snapshotRows(t, chr, int(pos)) for t in self.tiers])
+
+        key = (chr, int(pos)) if pos.isdigit() else None
+        if (key in self.prefetched):
+            return self.resolve(int(pos), alleles, self.prefetched[key])
+
+        if ((self.engine == 'index') and pos.isdigit()):
+            return self.resolve(int(pos), alleles, 
+                [iv.tableIndex(self.cursor, self.tiers[i], chr, 
+                    chromName='CHR', startName='start', 
+                    endName=self.endNames[i]).find(int(pos))
+                for i in range(len(self.tiers))])
+
+        sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+        sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + ';'
+
+        sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+            str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= end ;'
+
+        for sql in [sql1, sql2, sql3]:
+            rows = self.query(sql)
+            if (len(rows) > 0):
+                return rows
+        return rows
+
+    """Applies the conditions of the three queries to candidate rows of
+    each table (in table order) and returns the first tier that matches
+    """
+    def resolve(self, pos, alleles, candidates):
+        # String comparison in MySQL ignores case
+        alleles = [(r.upper(), a.upper()) for (r, a) in alleles]
+        tiers = [
+            [row for row in candidates[0] if ((int(row[2]) == pos) and
+                ((str(row[4]).upper(), str(row[5]).upper()) in alleles))],
+            [row for row in candidates[1] if (int(row[2]) == pos)],
+            [row for row in candidates[2] 
+                if (int(row[2]) <= pos <= int(row[3]))]]
+        for rows in tiers:
+            if (len(rows) > 0):
+                return rows
+        return tiers[-1]
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    def apply(self, record, rows):
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeqRow(row[1:len(row)]))
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+            record.extendInfo(';' + ';'.join(m))
+            if record.infoStartsWith(".;"):
+                record[7] = str(record[7]).replace('.;', '', 1)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    engine='batch'):
+    runStage(BigRefGeneStage(format=format, engine=engine), vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+"""Get information about location in gene structures
+"""
+class GenesStage(Stage):
+    echo = True
+    # positionType is counted from the INFO written by BigRefGeneStage
+    requires = (BigRefGeneStage,)
+    positionTypes = {'intron': 'intronic', 
+        'non_coding_intron': 'non_coding_intronic', 'CDS': 'cds',
+        'non_coding_exon': 'non_coding_exonic', 'utr5': 'utr5', 
+        'utr3': 'utr3'}
+
+    def __init__(self, table='refGene', format='vcf', promoter_offset=500):
+        Stage.__init__(self, table=table, format=format)
+        self.promoter_offset = promoter_offset
+        self.transcripts = {}
+
+    def cacheId(self):
+        return Stage.cacheId(self) + ':' + str(self.promoter_offset)
+
+    # apply() only reads the gene name columns of the rows
+    def cacheResult(self, located):
+        return [(tuple([row[i] if (i in indicesKnownGenes) else None
+            for i in range(len(row))]),) + tuple(rest)
+            for (row, *rest) in located]
+
+    """Parsed exons of a refGene row, cached per transcript
+    """
+    def transcript(self, row):
+        key = (row[1], row[2], row[4], row[9], row[10])
+        if key not in self.transcripts:
+            self.transcripts[key] = Transcript(row)
+        return self.transcripts[key]
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        promoter_offset = self.promoter_offset
+
+        if (self.snapshot is not None):
+            return self.lookupSnapshot(chr, pos)
+
+        sql = 'select * from ' + self.table + ' where chrom="' + str(chr) + \
+            '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
+            str(promoter_offset) +');'
+        rows = self.query(sql)
+        return [(row,) + self.locate(row, chr, int(pos)) for row in rows]
+
+    def lookupSnapshot(self, chr, pos):
+        pos = int(pos)
+        offset = int(self.promoter_offset)
+        rows = self.snapshotRows(self.table, chr, pos - offset, pos + offset)
+        return [(row,) + self.locate(row, chr, pos) for row in rows]
+
+    """Location of pos in the transcript described by the refGene row;
+    returns the region annotation and the exonic and promoter hit counts
+    """
+    def locate(self, row, chr, pos):
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        transcript = self.transcript(row)
+        exonCount = transcript.exonCount
+        strand = str(row[3])
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
+        exonic = 0
+        promoter = 0
+        exons = []
+
+        if (cdsStart == cdsEnd):
+            for e in transcript.exons(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            for e in transcript.exons(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("exon=" +  "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                exonic = exonic + 1
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            cpg = self.cpgIsland(chr, pos)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(cpg[3]).split())
+                promoter = promoter + 1
+
+        return (region, exonic, promoter)
+
+    def cpgIsland(self, chr, pos):
+        if (self.snapshot is not None):
+            table = self.snapshot.table('cpgIslandExt')
+            rows = table.find(chr, pos)
+            if (len(rows) == 0):
+                return None
+            return tuple([rows[0][table.column(c)] 
+                for c in ['chrom', 'chromStart', 'chromEnd', 'name']])
+
+        # The islands of a chromosome are loaded once, on first use
+        rows = iv.tableIndex(self.cursor, 'cpgIslandExt', chr,
+            columns='chrom, chromStart, chromEnd, name').find(int(pos))
+        return rows[0] if (len(rows) > 0) else None
+
+    def apply(self, record, located):
+        info = []
+
+        if (len(located) > 0):
+            positionType = record.infoValue('positionType')
+            cnt = 1
+            for (row, region, exonic, promoter) in located:
+                #count location
+                if (positionType in self.positionTypes):
+                    self.count(self.positionTypes[positionType])
+
+                self.count('exonic', exonic)
+                self.count('promoter', promoter)
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            record.extendInfo(';' + str_info)
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        else:
+            record.extendInfo(";positionType=interGenic")
+            self.count('interGenic')
+
+    def summary(self):
+        c = self.counts
+        return ["Variants located:",
+            f"In interGenic {str(c.get('interGenic', 0))}",
+            f"In CDS {str(c.get('cds', 0))}",
+            f"In \'3 UTR {str(c.get('utr3', 0))}",
+            f"In \'5 UTR {str(c.get('utr5', 0))}",
+            f"In Intronic {str(c.get('intronic', 0))}",
+            f"In Non_coding_intronic {str(c.get('non_coding_intronic', 0))}",
+            f"In Exonic {str(c.get('exonic', 0))}",
+            f"In Non_coding_exonic {str(c.get('non_coding_exonic', 0))}",
+            f"In Putative Promoter Region {str(c.get('promoter', 0))}"]
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(GenesStage(table=table, format=format, 
+        promoter_offset=promoter_offset), vcf, tmpextin=tmpextin, 
+        tmpextout=tmpextout, sep=sep)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
 
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonsEtAlStage(GenesStage):
+    requires = ()
+
+    def locate(self, row, chr, pos):
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        transcript = self.transcript(row)
+        exonCount = transcript.exonCount
+        strand = str(row[3])
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
+        hits = {}
+        exons = []
+
+        if (cdsStart == cdsEnd):
+            for e in transcript.exons(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum =  exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                hits['non_coding_exonic'] = hits.get('non_coding_exonic', 0) + 1
+            if (len(exons) > 0):
+                region='positionType=non_coding_exon;' + ";".join(exons)
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+                hits['non_coding_intronic'] = 1
+                region = 'positionType=non_coding_intron'
+
+        elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+            hits['cds'] = 1
+            for e in transcript.exons(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum =  exonCount - e
+                exons.append("exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                hits['exonic'] = hits.get('exonic', 0) + 1
+            if (len(exons) > 0):
+                region = 'positionType=CDS;' + ";".join(exons)
+            else:
+                hits['intronic'] = 1
+                region = 'positionType=CDS;' + 'intron'
+
+        elif (u.isBetween(pos, txtStart, cdsStart) and \
+            (cdsStart < cdsEnd) and (strand == "+")):
+            hits['utr5'] = 1
+            region = 'positionType=utr5'
+
+        elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+            (cdsStart < cdsEnd) and (strand == "+")):
+            hits['utr3'] = 1
+            region = 'positionType=utr3'
+
+        elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+            (cdsStart < cdsEnd) and (strand == "-")):
+            hits['utr5'] = 1
+            region = 'positionType=utr5'
+
+        elif (u.isBetween(pos, txtStart, cdsStart) and \
+            (cdsStart < cdsEnd) and (strand == "-")):
+            hits['utr3'] = 1
+            region = 'positionType=utr3'
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            cpg = self.cpgIsland(chr, pos)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(cpg[3]).split())
+                hits['promoter'] = 1
+
+        return (region, hits)
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        promoter_offset = self.promoter_offset
+
+        if (self.snapshot is not None):
+            return self.lookupSnapshot(chr, pos)
+
+        sql = 'select * from ' + self.table + ' where chrom="' + str(chr) + \
+            '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
+            str(promoter_offset) +');'
+        rows = self.query(sql)
+        return [(row,) + self.locate(row, chr, int(pos)) for row in rows]
+
+    def apply(self, record, located):
+        info = []
+        if (len(located) > 0):
+            cnt = 1
+            for (row, region, hits) in located:
+                for key in hits:
+                    self.count(key, hits[key])
+
+                if (region != ''):
+                    info.append(collapseGeneNames(
+                        row=row, indices=indicesKnownGenes, 
+                        region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            record.extendInfo(';' + str_info)
 
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+            record.extendInfo(";positionType=interGenic")
+            self.count('interGenic')
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(ExonsEtAlStage(table=table, format=format, 
+        promoter_offset=promoter_offset), vcf, tmpextin=tmpextin, 
+        tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesStage(OverlapStage):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    def __init__(self, table='tfbsConsSites', format='vcf'):
+        OverlapStage.__init__(self, table=table, format=format)
+
+    def lookup(self, record):
+        # For some reason this table has no "chr" preceeding number
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        chrIndex = chr.replace('chr', '')
+
+        if (chrIndex not in self.allowed_chrom):
+            return []
+
+        if (self.snapshot is not None):
+            if not pos.isdigit():
+                return []
+            table = self.snapshot.table('tfbsConsSites' + chrIndex)
+            cols = [table.column(c) 
+                for c in ['chrom', 'chromStart', 'chromEnd', 'name']]
+            return [tuple([row[i] for i in cols]) 
+                for row in table.findAll(int(pos))]
+
+        sql = 'select chrom, chromStart, chromEnd, name ' + \
+            'from tfbsConsSites' + chrIndex + \
+            ' where  chromStart <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= chromEnd;'
+        return self.query(sql)
+
+    def apply(self, record, rows):
+        records = []
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+
+            record.appendInfo(';'.join(records))
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(TfbsConsSitesStage(table=table, format=format), vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GadAllStage(OverlapStage):
+    chromName = 'chromosome'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, table='gadAll', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def lookup(self, record):
+        # For some reason this table has no "chr" preceeding number
+        chr = self.chromNoPrefix(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def apply(self, record, rows):
+        records = []
+        if (len(rows) > 0):
+            self.count('line')
+            r_tmp = []
+            for row in rows:
+                self.count('var')
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            record.appendInfo(';'.join(records))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            # Annotated lines have always been written out with '\t ' 
+            # between columns; keep the output unchanged
+            record.indent()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', engine='sql'):
+    runStage(GadAllStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GwasCatalogStage(OverlapStage):
+    def __init__(self, table='gwasCatalog', format='vcf'):
+        OverlapStage.__init__(self, table=table, format=format)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (self.snapshot is not None):
+            if not pos.isdigit():
+                return []
+            return self.snapshotRows(self.table, chr, int(pos))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        sql = 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND chromEnd = ' + str(pos) + ';'
+        return self.query(sql)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    def apply(self, record, rows):
+        records = []
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            record.appendInfo(';'.join(records))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(GwasCatalogStage(table=table, format=format), vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class HugoStage(OverlapStage):
+    def __init__(self, table='hugo', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos)
+
+    def apply(self, record, rows):
+        records = []
+        if (len(rows) > 0):
+            self.count('line')
+            r_tmp = []
+            for row in rows:
+                self.count('var')
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
+
+            record.appendInfo(','.join(records).replace(';', ','))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
+    runStage(HugoStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(self, table='genomicSuperDups', format='vcf', 
+        engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos, first=True)
+
+    def apply(self, record, row):
+        if row is not None:
+            self.count('line')
+            self.count('var')
+            record.extendInfo(';' + str(self.table) + '=' + \
+                str(True) + ';' + 'otherChrom=' + \
+                str(row[7]) + ';otherStart=' + \
+                str(row[8]) + ';otherEnd=' + str(row[9]))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', 
+    engine='sql'):
+    runStage(GenomicSuperDupsStage(table=table, format=format, 
+        engine=engine), vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneStage(OverlapStage):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1452,131 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def __init__(self, table='refGene', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, record, rows):
+        overlapsWith = []
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+            genes = ';'.join([str(x) for x in overlapsWith])
+            record.appendInfo(str(genes))
 
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
+    runStage(RefGeneStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Method to find overlap with Cytoband table
+"""
+class CytobandStage(OverlapStage):
+    def __init__(self, table='cytoBand', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
+
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos)
+
+    def apply(self, record, rows):
+        overlapsWith = []
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            record.appendInfo(str(self.table) + '=' + str(cytoband))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
+    runStage(CytobandStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvStage(OverlapStage):
+    def __init__(self, table='dgv_Cnv', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos, first=True)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, record, row):
+        if row is not None:
+            self.count('line')
+            self.count('var')
+            record.appendInfo(str(self.table) + '=' + str(True))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
+    runStage(CnvStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(OverlapStage):
+    def __init__(self, table='targetScanS', format='vcf', engine='sql'):
+        OverlapStage.__init__(self, table=table, format=format, 
+            engine=engine)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def lookup(self, record):
+        chr = self.chrom(record)
+        pos = record[self.inds[1]].strip()
+        return self.overlapping(chr, pos, first=True)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, record, row):
+        if row is not None:
+            self.count('line')
+            self.count('var')
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            record.appendInfo('miRNAsites=' + t.strip())
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def summary(self):
+        return [f"In miRNAsites: {str(self.counts.get('var', 0))} in " + \
+            f"{str(self.counts.get('line', 0))} variants"]
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', engine='sql'):
+    runStage(MiRNAStage(table=table, format=format, engine=engine), 
+        vcf, 
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,234 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Throughput benchmark: annotates the bundled data VCFs with each
+# driver.run configuration and reports variants per second, peak RSS
+# and query counts per stage as JSON, compared against a baseline
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+FILES = ['test', 'free_1', 'free_2', 'premium_1', 'premium_2', 'premium_3']
+
+"""driver.run keyword arguments of each benchmarked configuration
+"""
+CONFIGS = [
+    ('stream', {}),
+    ('chain', {'mode': 'chain'}),
+    ('parallel', {'mode': 'parallel'}),
+    ('concurrent', {'concurrent': True}),
+    ('inflight', {'inflight': 8}),
+    ('sql', {'engine': 'sql'}),
+    ('index', {'engine': 'index'}),
+]
+
+"""Relative slowdown of variants per second reported as a regression
+"""
+TOLERANCE = 0.1
+
+
+"""Child process: annotates a copy of vcf in a scratch directory and
+sends back the run's metrics report and peak RSS
+"""
+def runOnce(vcf, kwargs, conn):
+    import driver
+    scratch = tempfile.mkdtemp(prefix='anntools-bench-')
+    try:
+        infile = os.path.join(scratch, os.path.basename(vcf))
+        shutil.copyfile(vcf, infile)
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            driver.run(infile, 'vcf', **kwargs)
+        fh = open(infile + '.metrics.json')
+        report = json.load(fh)
+        fh.close()
+        # the largest single process: this one or a parallel worker
+        report['peakRssKb'] = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        conn.send(report)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        conn.close()
+
+
+"""Runs one configuration over vcf in a fresh process, so that the peak
+RSS is that of this run alone; returns the metrics report
+"""
+def measure(vcf, kwargs):
+    context = multiprocessing.get_context('spawn')
+    (parent, child) = context.Pipe(duplex=False)
+    process = context.Process(target=runOnce, args=(vcf, kwargs, child))
+    process.start()
+    child.close()
+    try:
+        report = parent.recv()
+    except EOFError:
+        report = None
+    process.join()
+    if (report is None) or (process.exitcode != 0):
+        raise RuntimeError(f"benchmark run failed: {vcf} {kwargs}")
+    return report
+
+
+"""Benchmarks configuration name over vcf repeat times; the figures are
+those of the run with the median wall time
+"""
+def bench(name, kwargs, vcf, repeat=1):
+    reports = [measure(vcf, kwargs) for i in range(repeat)]
+    walls = [r['wall'] for r in reports]
+    median = statistics.median_low(walls)
+    report = reports[walls.index(median)]
+
+    records = report['stages'][0]['records'] if report['stages'] else 0
+    stages = []
+    for s in report['stages']:
+        stages.append({
+            'label': s['label'],
+            'stage': s['stage'],
+            'table': s['table'],
+            'wall': s['wall'],
+            'cpu': s['cpu'],
+            'variantsPerSecond': s['recordsPerSecond'],
+            'queries': s['queries'],
+            'latencyMs': s['latencyMs'],
+        })
+    return {
+        'config': name,
+        'file': os.path.basename(vcf),
+        'records': records,
+        'wall': report['wall'],
+        'walls': walls,
+        'variantsPerSecond': round(records / report['wall'], 3)
+            if (report['wall'] > 0) else None,
+        'peakRssMb': round(report['peakRssKb'] / 1024, 1),
+        'queries': sum(s['queries'] for s in stages),
+        'stages': stages,
+    }
+
+
+"""Compares results with those of a baseline; returns a list of
+(result, baseline result, regressed) for the cases both ran. A case
+regresses when its variants per second drop by more than tolerance, or
+when it makes more queries.
+"""
+def compare(results, baseline, tolerance=TOLERANCE):
+    previous = {}
+    for b in baseline['results']:
+        previous[(b['config'], b['file'])] = b
+
+    compared = []
+    for r in results:
+        b = previous.get((r['config'], r['file']))
+        if (b is None):
+            continue
+        regressed = (r['queries'] > b['queries'])
+        if (r['variantsPerSecond'] and b['variantsPerSecond']):
+            change = r['variantsPerSecond'] / b['variantsPerSecond'] - 1
+            regressed = regressed or (change < -tolerance)
+        compared.append((r, b, regressed))
+    return compared
+
+
+def printComparison(compared):
+    for (r, b, regressed) in compared:
+        change = ''
+        if (r['variantsPerSecond'] and b['variantsPerSecond']):
+            change = '{:+.1%}'.format(
+                r['variantsPerSecond'] / b['variantsPerSecond'] - 1)
+        print('{:<12}{:<16}{:>12}{:>12}{:>9}{:>9}{:>9}  {}'.format(
+            r['config'], r['file'], b['variantsPerSecond'],
+            r['variantsPerSecond'], change, b['queries'], r['queries'],
+            'REGRESSED' if regressed else 'ok'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark driver.run over the bundled data VCFs')
+    parser.add_argument('--config', action='append',
+        choices=[name for (name, kwargs) in CONFIGS],
+        help='configuration to run (repeatable; default all)')
+    parser.add_argument('--file', action='append',
+        help='data VCF name or path (repeatable; default all bundled files)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='runs per case; the median run is reported (default 3)')
+    parser.add_argument('--db',
+        help='SQLite reference database to annotate from (see refdb.py)')
+    parser.add_argument('--snapshot',
+        help='reference snapshot directory to annotate from')
+    parser.add_argument('--output', default='benchmark.json',
+        help='JSON results file (default benchmark.json)')
+    parser.add_argument('--baseline',
+        help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+        help='slowdown reported as a regression (default 0.1)')
+    args = parser.parse_args()
+
+    configs = [(name, dict(kwargs)) for (name, kwargs) in CONFIGS
+        if (args.config is None) or (name in args.config)]
+    files = []
+    for f in (args.file or FILES):
+        files.append(f if os.path.exists(f)
+            else os.path.join(DATA_DIR, f.replace('.vcf', '') + '.vcf'))
+
+    # a shared variant cache would turn later runs into cache hits
+    os.environ.pop('ANNTOOLS_CACHE', None)
+    if args.db:
+        os.environ['ANNTOOLS_DB'] = os.path.abspath(args.db)
+
+    results = []
+    for (name, kwargs) in configs:
+        if args.snapshot:
+            kwargs['snapshot'] = args.snapshot
+        for vcf in files:
+            result = bench(name, kwargs, vcf, repeat=args.repeat)
+            print('{:<12}{:<16}{:>10} variants/s {:>8} queries {:>8} MB'.format(
+                name, result['file'], result['variantsPerSecond'],
+                result['queries'], result['peakRssMb']))
+            results.append(result)
+
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'db': args.db or os.environ.get('ANNTOOLS_DB', 'mysql'),
+        'snapshot': args.snapshot,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    fh = open(args.output, 'w')
+    json.dump(report, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+
+    if args.baseline:
+        fh = open(args.baseline)
+        baseline = json.load(fh)
+        fh.close()
+        compared = compare(results, baseline, tolerance=args.tolerance)
+        printComparison(compared)
+        if any(regressed for (r, b, regressed) in compared):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
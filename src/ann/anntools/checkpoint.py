@@ -0,0 +1,259 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checkpoints of an annotation job, so that a job restarted after its
+# instance went away resumes where it stopped instead of starting over
+#
+# A checkpoint is a small JSON file in the job directory naming the
+# step the job reached (see driver.run) and the files it needs to go on
+# from there. It can be mirrored, with those files, to S3, so that the
+# job also resumes on another instance. Files that only grow, such as
+# the result of the stream mode, are mirrored a part at a time: each
+# upload holds just the bytes added since the last one.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import os
+import re
+import shutil
+import time
+
+"""Seconds between checkpoints within a step; set
+ANNTOOLS_CHECKPOINT_SECONDS to change it
+"""
+CHECKPOINT_SECONDS = float(os.environ.get('ANNTOOLS_CHECKPOINT_SECONDS', 30))
+
+"""Seconds between uploads of the checkpoint to the mirror; set
+ANNTOOLS_MIRROR_SECONDS to change it
+"""
+MIRROR_SECONDS = float(os.environ.get('ANNTOOLS_MIRROR_SECONDS', 300))
+
+
+"""Checkpoint of one job, kept in path
+
+key identifies the job's input and settings (see driver.run): a saved
+checkpoint is only used by a run with the same key. save() writes the
+state atomically; the files it lists must already be on disk. They are
+uploaded to the mirror, if any, at most every mirrorInterval seconds
+(and whenever save() is told to), the checkpoint itself last. Files
+listed as appended only grow; the mirror gets the bytes added since
+their last upload, and keeps doing so when they are listed again in
+files.
+"""
+class Checkpoint(object):
+    def __init__(self, path, mirror=None, interval=CHECKPOINT_SECONDS,
+        mirrorInterval=MIRROR_SECONDS):
+        self.path = path
+        self.mirror = mirror
+        self.interval = interval
+        self.mirrorInterval = mirrorInterval
+        self.key = None
+        self.last = time.monotonic()
+        self.mirrored = time.monotonic()
+        self.pending = []
+        self.appended = set([])
+        # bytes of each appended file already on the mirror
+        self.mirroredSizes = None
+
+    """Fetches the checkpoint and its files from the mirror, unless there
+    is a checkpoint here already
+    """
+    def restore(self):
+        if ((self.mirror is not None) and not os.path.exists(self.path)):
+            self.mirror.restore(os.path.dirname(os.path.abspath(self.path)),
+                os.path.basename(self.path))
+
+    """The saved state of the job with key, or None
+    """
+    def load(self, key=None):
+        self.key = key if (key is not None) else self.key
+        if not os.path.exists(self.path):
+            return None
+        fh = open(self.path)
+        try:
+            state = json.load(fh)
+        except ValueError:
+            return None
+        finally:
+            fh.close()
+        if (state.get('key') != self.key):
+            return None
+        return state
+
+    """True once the interval has passed since the last checkpoint
+    """
+    def due(self):
+        return (time.monotonic() - self.last >= self.interval)
+
+    def save(self, state, files=(), mirror=False, appended=()):
+        state = dict(state)
+        state['key'] = self.key
+        state['time'] = int(time.time())
+        tmp = self.path + '.tmp'
+        fh = open(tmp, 'w')
+        json.dump(state, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.replace(tmp, self.path)
+        self.last = time.monotonic()
+
+        if (self.mirror is None):
+            return
+        self.appended.update(appended)
+        for path in list(files) + list(appended):
+            if (path not in self.pending):
+                self.pending.append(path)
+        if (mirror or
+            (time.monotonic() - self.mirrored >= self.mirrorInterval)):
+            for path in self.pending:
+                if not os.path.exists(path):
+                    continue
+                if (path in self.appended):
+                    self.uploadAppended(path)
+                else:
+                    self.mirror.upload(path)
+            self.mirror.upload(self.path)
+            self.pending = []
+            self.mirrored = time.monotonic()
+
+    """Uploads the bytes of path added since its last upload
+    """
+    def uploadAppended(self, path):
+        if (self.mirroredSizes is None):
+            # parts left by an earlier run of the job
+            self.mirroredSizes = self.mirror.partEnds()
+        name = os.path.basename(path)
+        start = self.mirroredSizes.get(name, 0)
+        end = os.path.getsize(path)
+        if (end > start):
+            self.mirror.uploadPart(path, start, end)
+            self.mirroredSizes[name] = end
+
+    """Removes the checkpoint, here and on the mirror, once the job is done
+    """
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if (self.mirror is not None):
+            self.mirror.clear()
+
+
+"""Copies of checkpoint files under s3://bucket/prefix/; a file mirrored
+a part at a time is kept as <name>.part.<start>.<end> objects, each
+holding its bytes from start to end
+"""
+class S3Mirror(object):
+    PART = re.compile(r'^(.*)\.part\.(\d+)\.(\d+)$')
+
+    def __init__(self, bucket, prefix, s3=None, region_name=None):
+        if (s3 is None):
+            import boto3
+            s3 = boto3.client('s3', region_name=region_name)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/') + '/'
+
+    def upload(self, path):
+        self.s3.upload_file(path, self.bucket,
+            self.prefix + os.path.basename(path))
+
+    def uploadPart(self, path, start, end):
+        fh = open(path, 'rb')
+        fh.seek(start)
+        try:
+            self.s3.upload_fileobj(FileRange(fh, end - start), self.bucket,
+                self.prefix + os.path.basename(path) + '.part.' +
+                '%015d' % start + '.' + '%015d' % end)
+        finally:
+            fh.close()
+
+    """Bytes mirrored of each file uploaded in parts, by file name
+    """
+    def partEnds(self):
+        ends = {}
+        for key in self.keys():
+            m = self.PART.match(key[len(self.prefix):])
+            if m:
+                ends[m.group(1)] = max(ends.get(m.group(1), 0),
+                    int(m.group(3)))
+        return ends
+
+    def keys(self):
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    """Downloads the mirrored files into directory if the checkpoint
+    (named name) is among them; returns whether it was
+    """
+    def restore(self, directory, name):
+        keys = self.keys()
+        if ((self.prefix + name) not in keys):
+            return False
+        # the checkpoint last, as it was uploaded
+        keys.remove(self.prefix + name)
+        parted = set([])
+        for key in sorted(keys) + [self.prefix + name]:
+            m = self.PART.match(key[len(self.prefix):])
+            if m:
+                path = os.path.join(directory, m.group(1))
+                self.restorePart(key, path, int(m.group(2)),
+                    fresh=(path not in parted))
+                parted.add(path)
+            else:
+                self.s3.download_file(self.bucket, key,
+                    os.path.join(directory, key[len(self.prefix):]))
+        return True
+
+    """Writes a part into the file at path, at offset start; the first part
+    (fresh) replaces whatever the file held
+    """
+    def restorePart(self, key, path, start, fresh=False):
+        tmp = path + '.part'
+        self.s3.download_file(self.bucket, key, tmp)
+        fh = open(path, 'wb' if fresh else 'r+b')
+        fh.seek(start)
+        fh_part = open(tmp, 'rb')
+        shutil.copyfileobj(fh_part, fh)
+        fh_part.close()
+        fh.close()
+        os.unlink(tmp)
+
+    def clear(self):
+        for key in self.keys():
+            self.s3.delete_object(Bucket=self.bucket, Key=key)
+
+
+"""Read-only file object for length bytes of fh from its position, for
+uploading part of a file
+"""
+class FileRange(object):
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.left = length
+
+    def read(self, size=-1):
+        if ((size is None) or (size < 0) or (size > self.left)):
+            size = self.left
+        data = self.fh.read(size)
+        self.left = self.left - len(data)
+        return data
+
+
+"""Checkpoint of the job for infile, in infile.checkpoint.json; mirrored
+to S3 under s3://bucket/prefix/ when bucket is given
+"""
+def forFile(infile, bucket=None, prefix=None, region_name=None):
+    mirror = None
+    if bucket:
+        mirror = S3Mirror(bucket, prefix, region_name=region_name)
+    return Checkpoint(infile + '.checkpoint.json', mirror=mirror)
+
+### EOF
@@ -12,111 +12,281 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import time
 import file_utils as fu
 import annotate as ann
+import pipeline as pl
+import parallel as par
+import varcache as vc
+import vcfio as vio
+import tabix as ti
+import metrics as mt
+import checkpoint as cp
+import progress as pg
 
-def run(infile, format):
+"""Annotation stages in the order they are applied, each paired with
+the label printed once the stage is done; engine selects how the
+range-overlap stages search their tables (see annotate.OverlapStage).
+BigRefGene has no sweep engine and is batched unless engine is 'sql'
+or 'index'.
+"""
+def stages(engine='sweep'):
+    refGeneEngine = engine if (engine in ['sql', 'index']) else 'batch'
+    return [
+        ("dbSNP", ann.DbSnpStage(format='vcf')),
+        ("BigRefGene", ann.BigRefGeneStage(format='vcf', 
+            engine=refGeneEngine)),
+        ("BigRefGene", ann.GenesStage(format='vcf', table='refGene',
+            promoter_offset=500)),
+        ("Cytoband", ann.CytobandStage(format='vcf', table='cytoBand',
+            engine=engine)),
+        ("gadAll", ann.GadAllStage(format='vcf', table='gadAll',
+            engine=engine)),
+        ("GwasCatalog", ann.GwasCatalogStage(format='vcf',
+            table='gwasCatalog')),
+        ("miRNA", ann.MiRNAStage(format='vcf', table='targetScanS',
+            engine=engine)),
+        ("HUGO Gene Nomenclature Committee", ann.HugoStage(format='vcf',
+            table='hugo', engine=engine)),
+        ("dgv_Cnv", ann.CnvStage(format='vcf', table='dgv_Cnv',
+            engine=engine)),
+        ("abParts_IG_T_CelReceptors", ann.CnvStage(format='vcf',
+            table='abParts_IG_T_CelReceptors', engine=engine)),
+        ("mcCarroll_Cnv", ann.CnvStage(format='vcf', table='mcCarroll_Cnv',
+            engine=engine)),
+        ("conrad_Cnv", ann.CnvStage(format='vcf', table='conrad_Cnv',
+            engine=engine)),
+        ("genomicSuperDups", ann.GenomicSuperDupsStage(format='vcf',
+            table='genomicSuperDups', engine=engine)),
+        ("addOverlapWithTfbsConsSites", ann.TfbsConsSitesStage(
+            table='tfbsConsSites')),
+    ]
+
+
+"""Name of the annotated result file for infile: x.vcf gives
+x.annot.vcf and x.vcf.gz gives x.annot.vcf.gz; compress adds (or drops)
+the compressed extension, by default kept as on infile. A pileup x
+gives x.annot.vcf, as its conversion x.vcf would.
+"""
+def resultFile(infile, compress=None, format='vcf'):
+    (base, ext) = vio.splitExtension(infile)
+    if (format == 'pileup'):
+        base = base + '.vcf'
+    result = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if (compress is None):
+        compress = (len(ext) > 0)
+    return (result + (ext or '.gz')) if compress else result
+
+
+"""Runs the annotation pipeline on infile
+
+mode='stream' (the default) parses each record once and passes it
+through every stage in memory, writing only the result file and the
+.count.log. mode='chain' runs one stage at a time over the whole file,
+writing a numbered temporary file per stage; both produce identical
+output. engine is passed on to stages().
+
+mode='parallel' cuts the input into shards by chromosome and annotates
+them in a pool of worker processes (all cores by default), see
+parallel.py; the output is the same as in the other modes.
+
+snapshot is the path of a reference snapshot directory (see
+snapshot.py) to annotate from instead of the database; it defaults to
+the ANNTOOLS_SNAPSHOT environment variable.
+
+With concurrent=True the stream and parallel modes look up the
+independent stages concurrently, each on its own connection (see
+pipeline.annotateBlockConcurrently).
+
+cache is the path of a persistent variant cache shared across jobs
+(see varcache.py), used by the stream and parallel modes; it defaults
+to the ANNTOOLS_CACHE environment variable. Entries are keyed by
+refversion, by default ANNTOOLS_REFVERSION or else the version of a
+SQLite reference database; it must be given to use the cache with
+MySQL or a snapshot (see varcache.fromEnvironment).
+
+inflight > 1 keeps up to that many lookups of a stage in flight, on as
+many worker threads with a pooled connection each, in the stream and
+parallel modes (see inflight.py); the default is ANNTOOLS_INFLIGHT, or
+one at a time.
+
+infile may be gzip or BGZF compressed (.vcf.gz, .vcf.bgz). The result
+is written BGZF compressed when compress is set, by default when
+infile has a compressed extension; see resultFile() for its name.
+
+format='pileup' annotates a samtools pileup (plain or compressed)
+directly: it is converted to VCF as it is read (see pileup2vcf.py),
+without an intermediate file, and the result is a VCF.
+
+With index=True the result is sorted by chromosome and position,
+written BGZF compressed and indexed in resultFile() + '.tbi', so that
+regions can be read without the whole file (see tabix.py).
+
+The time, records per second and database queries of every stage are
+written to infile.metrics.json (see metrics.py).
+
+checkpoint is a checkpoint.Checkpoint, or True for one in
+infile.checkpoint.json; it defaults to on when ANNTOOLS_CHECKPOINT is
+set. Progress is then saved per chunk of records (stream), per stage
+(chain) or per shard (parallel), and a run of the same input with the
+same settings resumes from the last checkpoint saved. The checkpoint
+is removed once the run is done.
+
+progress is a progress.Progress, or a function, called with the records
+done by each stage and the estimated time remaining at most every
+ANNTOOLS_PROGRESS_SECONDS while the stages run (see progress.py).
+"""
+def run(infile, format, mode='stream', engine='sweep', snapshot=None,
+    workers=None, concurrent=False, cache=None, refversion=None,
+    inflight=None, compress=None, index=False, checkpoint=None,
+    progress=None):
 
     print("Running . . .")
+    start = time.perf_counter()
+
+    snapshot = snapshot or os.environ.get('ANNTOOLS_SNAPSHOT')
+    cache = vc.fromEnvironment(path=cache, refversion=refversion,
+        snapshot=snapshot)
+    inflight = inflight or int(os.environ.get('ANNTOOLS_INFLIGHT', 1))
+    if (compress is None):
+        compress = (len(vio.splitExtension(infile)[1]) > 0)
+    if index:
+        # annotated into a plain file first, then sorted and compressed
+        compress = False
+
+    if (checkpoint is None):
+        checkpoint = bool(os.environ.get('ANNTOOLS_CHECKPOINT'))
+    if (checkpoint is True):
+        checkpoint = cp.forFile(infile)
+    elif (checkpoint is False):
+        checkpoint = None
+    state = None
+    if (checkpoint is not None):
+        checkpoint.restore()
+        state = checkpoint.load(key={'input': os.path.basename(infile),
+            'size': os.path.getsize(infile), 'format': format, 'mode': mode,
+            'engine': engine, 'compress': compress, 'index': index})
+
+    annotated = ((state is not None) and (state['step'] == 'annotated'))
+    labelled = stages(engine=engine)
+    if ((progress is not None) and not isinstance(progress, pg.Progress)):
+        progress = pg.Progress(progress)
+    if ((progress is not None) and not annotated):
+        progress.start(labelled, vio.recordestimate(infile, format=format))
+
+    # the reports stop however the run ends
+    done = False
+    try:
+        if annotated:
+            # the result was complete before the restart
+            pass
+        elif (mode == 'parallel'):
+            par.runSharded(infile, [s for (label, s) in labelled],
+                resultFile(infile, compress, format), engine=engine,
+                workers=workers, snapshot=snapshot, concurrent=concurrent,
+                cache=cache, inflight=inflight, compress=compress,
+                checkpoint=checkpoint, format=format)
+            for (label, s) in labelled:
+                print(f"{label} - done.")
+        else:
+            if snapshot:
+                import snapshot as snap
+                snapshot = snap.Snapshot(snapshot)
+
+            if (mode == 'chain'):
+                runChain(infile, labelled=labelled, snapshot=snapshot,
+                    compress=compress, checkpoint=checkpoint, format=format)
+            else:
+                pl.runStream(infile, [s for (label, s) in labelled],
+                    resultFile(infile, compress, format), snapshot=snapshot,
+                    concurrent=concurrent, cache=cache, inflight=inflight,
+                    compress=compress, checkpoint=checkpoint, format=format)
+                for (label, s) in labelled:
+                    print(f"{label} - done.")
+
+            if snapshot:
+                snapshot.close()
+        done = True
+    finally:
+        if (progress is not None):
+            progress.stop(done=done)
+
+    if ((checkpoint is not None) and not annotated):
+        checkpoint.save({'step': 'annotated'}, files=[
+            resultFile(infile, compress, format), infile + '.count.log'],
+            mirror=True)
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    if index:
+        ti.sortAndIndex(resultFile(infile, False, format),
+            resultFile(infile, True, format))
+        fu.delete(resultFile(infile, False, format))
+
+    mt.write(infile + '.metrics.json', infile, mode, labelled,
+        time.perf_counter() - start)
+    if (checkpoint is not None):
+        checkpoint.clear()
+
+
+"""Runs the stages one at a time over the whole file; returns the
+(label, stage) pairs, those of stages(engine) unless labelled is given.
+The sample columns, if any, are set aside while the stages run and put
+back into the result (see annotate.detachSamples). A pileup
+(format='pileup') is converted to VCF as they are set aside.
+
+With a checkpoint, one is saved after each stage; a saved checkpoint is
+resumed from with the next stage.
+"""
+def runChain(infile, engine='sweep', snapshot=None, compress=False,
+    checkpoint=None, labelled=None, format='vcf'):
+    tmpextin = ''
+    tmpextout = 1
+
+    state = checkpoint.load() if (checkpoint is not None) else None
+    if ((state is not None) and (state['step'] == 'chain')):
+        samples = state['samples']
+        tmpextin = state['tmpextin']
+        tmpextout = state['done'] + 1
+        if fu.isExist(infile + '.count.log'):
+            os.truncate(infile + '.count.log', state['countlog'])
+    else:
+        samples = ann.hasSamples(infile, format=format)
+        if samples:
+            ann.detachSamples(infile, infile + '.0', infile + '.samples',
+                format=format)
+            tmpextin = '.0'
+
+    labelled = labelled or stages(engine=engine)
+    for (label, stage) in labelled[tmpextout - 1:]:
+        ann.runStage(stage, infile, tmpextin=tmpextin,
+            tmpextout='.' + str(tmpextout), snapshot=snapshot)
+        print(f"{label} - done.")
+        tmpextin = '.' + str(tmpextout)
+        if (checkpoint is not None):
+            countlog = infile + '.count.log'
+            checkpoint.save({'step': 'chain', 'done': tmpextout,
+                'tmpextin': tmpextin, 'samples': samples,
+                'countlog': fu.fileSize(countlog) if fu.isExist(countlog)
+                    else 0},
+                files=[infile + tmpextin, infile + '.count.log'] +
+                    ([infile + '.samples'] if samples else []))
+        tmpextout = tmpextout + 1
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(0 if samples else 1, tmpextout - 1):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if samples:
+        ann.attachSamples(infile + tmpextin, infile + '.samples',
+            resultFile(infile, compress, format), compress=compress)
+        fu.delete(infile + tmpextin)
+        fu.delete(infile + '.samples')
+    elif compress:
+        vio.compressFile(infile + tmpextin,
+            resultFile(infile, compress, format))
+        fu.delete(infile + tmpextin)
+    else:
+        os.rename(infile + tmpextin, resultFile(infile, compress, format))
+
+    return labelled
 
-### EOF
\ No newline at end of file
+### EOF
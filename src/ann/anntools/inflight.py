@@ -0,0 +1,72 @@
+# inflight.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Lookup layer keeping several reference queries in flight on a pool of
+# worker threads
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import itertools
+import threading
+import time
+from concurrent import futures
+
+import utils as u
+
+
+"""Looks up the records of a block in a stage with up to inflight
+lookups running at once, and returns the results in input order
+
+PyMySQL blocks, so each lookup runs on one of inflight worker threads,
+each holding its own pooled connection; the pool bounds how many are
+in flight. Stages whose lookups must run in input order (see
+annotate.Stage.independentLookups) are looked up one after the other.
+
+An instance is a callable for pipeline.annotateBlock(lookups=...).
+"""
+class InflightLookups(object):
+    def __init__(self, inflight=8):
+        self.inflight = inflight
+        self.executor = futures.ThreadPoolExecutor(max_workers=inflight,
+            initializer=self.connect)
+        self.local = threading.local()
+        self.conns = []
+        self.lock = threading.Lock()
+
+    """Worker thread initializer; the connections are given back to the
+    pool by close()
+    """
+    def connect(self):
+        self.local.conn = u.db_pool().get()
+        with self.lock:
+            self.conns.append(self.local.conn)
+
+    def __call__(self, stage, records):
+        if ((len(records) <= 1) or not stage.independentLookups()):
+            return [stage.lookup(record) for record in records]
+        # map() returns the results in the order of the records
+        return list(self.executor.map(self.lookup, itertools.repeat(stage),
+            records))
+
+    """Runs on a worker thread, with the stage using the thread's
+    connection; the thread's CPU time is added to the stage metrics
+    """
+    def lookup(self, stage, record):
+        stage.local.cursor = stage.track(self.local.conn.cursor())
+        cpu = time.thread_time()
+        try:
+            return stage.lookup(record)
+        finally:
+            stage.metrics.add(cpu=time.thread_time() - cpu)
+            del stage.local.cursor
+
+    def close(self):
+        self.executor.shutdown()
+        for conn in self.conns:
+            u.db_pool().put(conn)
+        self.conns = []
+
+### EOF
@@ -0,0 +1,261 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for the range-overlap annotation stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bisect
+
+import utils as u
+import refdb as rdb
+
+
+"""Intervals sorted by start, searchable in O(log n + k)
+
+Follows the implicit augmented interval tree used by cgranges (Heng Li):
+the positions in the sorted starts/ends lists form an implicit binary
+search tree, and maxends holds the largest end in each node's subtree.
+Intervals are closed, i.e. start <= pos <= end, as in the reference
+database queries. The lists may be any sequences, including memory
+mapped arrays; maxends is computed when not given.
+"""
+class SortedIntervals(object):
+    def __init__(self, starts, ends, maxends=None):
+        self.starts = starts
+        self.ends = ends
+        if (maxends is None):
+            maxends = self.prepare()
+        self.maxends = maxends
+        self.root = rootLevel(len(starts))
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Largest end in the subtree of every node
+    """
+    def prepare(self):
+        n = len(self.starts)
+        a = list(self.ends)
+        if (n == 0):
+            return a
+
+        last_i = 0
+        for i in range(0, n, 2):
+            last_i = i
+        last = a[last_i]
+
+        k = 1
+        while ((1 << k) <= n):
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                er = a[i + x] if (i + x < n) else last
+                a[i] = max(self.ends[i], a[i - x], er)
+            # move last_i to its parent
+            if ((last_i >> k) & 1):
+                last_i = last_i - x
+            else:
+                last_i = last_i + x
+            if ((last_i < n) and (a[last_i] > last)):
+                last = a[last_i]
+            k = k + 1
+
+        return a
+
+    """Positions (in sorted order) of the intervals overlapping lo..hi,
+    or containing lo when hi is not given
+    """
+    def search(self, lo, hi=None):
+        n = len(self.starts)
+        if (n == 0):
+            return []
+        if (hi is None):
+            hi = lo
+
+        starts = self.starts
+        ends = self.ends
+        maxends = self.maxends
+        hits = []
+        stack = [(self.root, (1 << self.root) - 1, False)]
+
+        while (len(stack) > 0):
+            (k, x, left_done) = stack.pop()
+            if (k <= 3):
+                # small subtree; scan it
+                i = x >> k << k
+                i1 = min(i + (1 << (k + 1)) - 1, n)
+                while ((i < i1) and (starts[i] <= hi)):
+                    if (lo <= ends[i]):
+                        hits.append(i)
+                    i = i + 1
+            elif not left_done:
+                y = x - (1 << (k - 1))
+                stack.append((k, x, True))
+                if ((y >= n) or (maxends[y] >= lo)):
+                    stack.append((k - 1, y, False))
+            elif ((x < n) and (starts[x] <= hi)):
+                if (lo <= ends[x]):
+                    hits.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+
+        return hits
+
+
+"""Level of the root of the implicit tree over n sorted intervals
+"""
+def rootLevel(n):
+    if (n == 0):
+        return -1
+    k = 1
+    while ((1 << k) <= n):
+        k = k + 1
+    return k - 1
+
+
+"""In-memory index of (start, end, value) intervals
+
+Hits are returned in the order the intervals were given, so the first
+hit is the row a query would have returned first.
+"""
+class IntervalIndex(SortedIntervals):
+    def __init__(self, intervals):
+        items = sorted(enumerate(intervals), key=lambda x: (x[1][0], x[0]))
+        self.order = [i for (i, iv) in items]
+        self.values = [iv[2] for (i, iv) in items]
+        SortedIntervals.__init__(self, [iv[0] for (i, iv) in items],
+            [iv[1] for (i, iv) in items])
+
+    """Values of the intervals overlapping lo..hi, in input order
+    """
+    def find(self, lo, hi=None):
+        hits = sorted(self.search(lo, hi), key=lambda i: self.order[i])
+        return [self.values[i] for i in hits]
+
+
+"""Indexes are loaded once per table and chromosome, and kept for the
+life of the process; the values are the rows of the table, or just the
+given columns
+"""
+_indexes = {}
+
+def tableIndex(cursor, table, chr, chromName='chrom',
+    startName='chromStart', endName='chromEnd', columns=None):
+    columns = columns or (table + '.*')
+    key = (table, chromName, startName, endName, columns, chr)
+    if key not in _indexes:
+        sql = 'select ' + startName + ', ' + endName + ', ' + columns + \
+            ' from ' + table + ' where ' + chromName + '="' + \
+            str(chr) + '";'
+        cursor.execute(sql)
+        _indexes[key] = IntervalIndex([(int(r[0]), int(r[1]), r[2:])
+            for r in cursor.fetchall()])
+
+    return _indexes[key]
+
+
+"""Raised when positions given to a sweep are not coordinate-sorted
+"""
+class UnsortedInput(ValueError):
+    pass
+
+
+"""Merge-join of non-decreasing positions against (start, end, value,
+order) intervals sorted by start (closed, as in IntervalIndex)
+
+Only the active intervals, those already started that may still contain
+a later position, are kept in memory. Hits are returned by order, the
+position of each interval in the table, so the first hit is the row a
+query would have returned first, as with IntervalIndex.
+"""
+class IntervalSweep(object):
+    def __init__(self, intervals):
+        self.intervals = iter(intervals)
+        self.pending = next(self.intervals, None)
+        # (order, end, value), sorted by order
+        self.active = []
+        self.last = None
+
+    def find(self, pos):
+        if ((self.last is not None) and (pos < self.last)):
+            raise UnsortedInput(f"position {pos} after {self.last}")
+        self.last = pos
+
+        while ((self.pending is not None) and (self.pending[0] <= pos)):
+            (start, end, value, order) = self.pending
+            bisect.insort(self.active, (order, end, value))
+            self.pending = next(self.intervals, None)
+
+        self.active = [a for a in self.active if (pos <= a[1])]
+        return [a[2] for a in self.active]
+
+
+"""Sweeps one table for an input sorted by chromosome and position
+
+The rows of each chromosome are streamed in start order, on a
+connection borrowed from the pool (see utils.db_pool) until close(),
+while the input moves along that chromosome. UnsortedInput is raised
+when a position goes backwards or a chromosome shows up again after the
+input has moved past it. observe, if given, is called with the latency
+of each query.
+"""
+class TableSweep(object):
+    def __init__(self, table, chromName='chrom', startName='chromStart',
+        endName='chromEnd', observe=None):
+        self.table = table
+        self.observe = observe
+        self.chromName = chromName
+        self.startName = startName
+        self.endName = endName
+        self.chr = None
+        self.conn = None
+        self.stream = None
+        self.sweep = None
+        self.done = set([])
+
+    def find(self, chr, pos):
+        if (chr != self.chr):
+            if (chr in self.done):
+                raise UnsortedInput(f"chromosome {chr} is not contiguous")
+            self.close()
+            self.done.add(chr)
+            self.chr = chr
+            self.conn = u.db_pool().get()
+            self.stream = tableStream(self.table, chr, conn=self.conn,
+                chromName=self.chromName, startName=self.startName,
+                endName=self.endName, observe=self.observe)
+            self.sweep = IntervalSweep(self.stream)
+
+        return self.sweep.find(pos)
+
+    def close(self):
+        if (self.stream is not None):
+            try:
+                self.stream.close()
+            except rdb.backend().errors:
+                u.db_pool().discard(self.conn)
+                self.conn = None
+        if (self.conn is not None):
+            u.db_pool().put(self.conn)
+        self.conn = None
+        self.stream = None
+        self.sweep = None
+
+
+"""Rows of one chromosome of a table as (start, end, row, order), sorted
+by start; order is the position of the row among those of the
+chromosome in table order, as IntervalIndex numbers them. The rows are
+read from conn, or a connection of their own.
+"""
+def tableStream(table, chr, chromName='chrom', startName='chromStart',
+    endName='chromEnd', observe=None, conn=None):
+    sql = 'select * from (select row_number() over () as _order, ' + \
+        startName + ' as _start, ' + endName + ' as _end, ' + table + \
+        '.* from ' + table + ' where ' + chromName + '="' + str(chr) + \
+        '") as numbered order by _start, _order;'
+    for r in u.db_stream(sql, observe=observe, conn=conn):
+        yield (int(r[1]), int(r[2]), r[3:], int(r[0]))
+
+### EOF
@@ -0,0 +1,153 @@
+# metrics.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage performance metrics: wall and CPU time, records per second,
+# reference database queries and their latency
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import threading
+import time
+from array import array
+
+
+"""Metrics of one annotation stage, added to from any thread
+
+wall and cpu are the seconds spent on the stage's records, summed over
+the threads that worked on them (CPU time is per thread, so the work of
+other stages running at the same time is not included). Each database
+query adds its latency in seconds.
+"""
+class StageMetrics(object):
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.records = 0
+        self.latencies = array('d')
+        self.lock = threading.Lock()
+
+    # the lock does not pickle; metrics of parallel shards are sent back
+    # to the parent process
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, wall=0.0, cpu=0.0, records=0):
+        with self.lock:
+            self.wall = self.wall + wall
+            self.cpu = self.cpu + cpu
+            self.records = self.records + records
+
+    def query(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def merge(self, other):
+        with self.lock:
+            self.wall = self.wall + other.wall
+            self.cpu = self.cpu + other.cpu
+            self.records = self.records + other.records
+            self.latencies.extend(other.latencies)
+
+    """Context manager adding the time spent in it, on the calling
+    thread, to the metrics
+    """
+    def timer(self, records=0):
+        return Timer(self, records)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'wall': round(self.wall, 6),
+            'cpu': round(self.cpu, 6),
+            'records': self.records,
+            'recordsPerSecond': round(self.records / self.wall, 3)
+                if (self.wall > 0) else None,
+            'queries': len(latencies),
+            'latencyMs': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+            },
+        }
+
+
+class Timer(object):
+    def __init__(self, metrics, records=0):
+        self.metrics = metrics
+        self.records = records
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add(wall=time.perf_counter() - self.wall,
+            cpu=time.thread_time() - self.cpu, records=self.records)
+
+
+"""Nearest-rank percentile of sorted latencies, in milliseconds, or
+None without any
+"""
+def percentile(latencies, p):
+    if (len(latencies) == 0):
+        return None
+    rank = max(int(-(-p * len(latencies) // 100)), 1)
+    return round(latencies[rank - 1] * 1000, 3)
+
+
+"""Database cursor recording the latency of each query in metrics
+"""
+class TimedCursor(object):
+    def __init__(self, cursor, metrics):
+        self.cursor = cursor
+        self.metrics = metrics
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(*args, **kwargs)
+        finally:
+            self.metrics.query(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+"""Writes the metrics of a run to path (infile.metrics.json); stages
+are (label, stage) pairs in stage order, wall the elapsed time of the
+whole run
+"""
+def write(path, infile, mode, stages, wall):
+    report = {
+        'file': infile,
+        'mode': mode,
+        'wall': round(wall, 6),
+        'stages': [],
+    }
+    for (label, stage) in stages:
+        summary = {'label': label, 'stage': type(stage).__name__,
+            'table': stage.table}
+        summary.update(stage.metrics.summary())
+        report['stages'].append(summary)
+
+    fh = open(path, 'w')
+    json.dump(report, fh, indent=2)
+    fh.write('\n')
+    fh.close()
+    return report
+
+### EOF
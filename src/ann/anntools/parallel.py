@@ -0,0 +1,202 @@
+# parallel.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sharded annotation: the input is cut into contiguous shards (at
+# chromosome boundaries too while it is sorted), the shards are
+# annotated in a process pool and the results joined back in order
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import multiprocessing
+
+import annotate as ann
+import file_utils as fu
+import pipeline as pl
+import vcfio as vio
+
+
+"""Fewest records a shard is cut at on a change of chromosome
+"""
+MIN_SHARD_SIZE = 1000
+
+
+"""Splits vcf into shard files of at most size records; lines before
+the first record stay with the first shard. Returns the shard file
+names in input order. vcf may be compressed, or a pileup read as VCF
+with format='pileup'; the shards are plain text VCF.
+
+While the input is sorted by chromosome and position, a shard also
+ends where the chromosome changes, once it holds MIN_SHARD_SIZE records
+(or size, if smaller), so that the sweep of each shard stays on one
+chromosome. Once a chromosome shows up again or a position goes back,
+as with a sweep (see intervals.TableSweep), the rest of the input is
+cut by record count alone.
+"""
+def split(vcf, size, sep='\t', format='vcf'):
+    shards = []
+    pending = []
+    fh_out = None
+    chr = None
+    pos = None
+    seen = set([])
+    ordered = True
+    records = 0
+    floor = min(size, MIN_SHARD_SIZE)
+
+    fh = vio.openInput(vcf, format=format)
+    for line in fh:
+        if ann.isHeader(line):
+            if (fh_out is None):
+                pending.append(line)
+            else:
+                fh_out.write(line)
+            continue
+
+        fields = line.split(sep, 2)
+        (this, at) = (fields[0], fields[1] if (len(fields) > 1) else '')
+        at = int(at) if at.isdigit() else None
+        if ordered and (this != chr) and (this in seen):
+            ordered = False
+        if (ordered and (this == chr) and (at is not None) and
+            (pos is not None) and (at < pos)):
+            ordered = False
+        seen.add(this)
+
+        if ((fh_out is None) or (records >= size) or
+            (ordered and (this != chr) and (records >= floor))):
+            if (fh_out is not None):
+                fh_out.close()
+            shards.append(vcf + '.shard' + str(len(shards)))
+            fh_out = open(shards[-1], 'w')
+            fh_out.writelines(pending)
+            pending = []
+            records = 0
+        chr = this
+        pos = at
+        fh_out.write(line)
+        records = records + 1
+    fh.close()
+
+    if (fh_out is None):
+        shards.append(vcf + '.shard0')
+        fh_out = open(shards[-1], 'w')
+        fh_out.writelines(pending)
+    fh_out.close()
+    return shards
+
+
+"""Worker: annotates one shard and returns the stage counters and
+metrics
+"""
+def annotateShard(args):
+    (shard, engine, snapshot, concurrent, cache, inflight) = args
+    import driver
+    stages = [s for (label, s) in driver.stages(engine=engine)]
+    if snapshot:
+        import snapshot as snap
+        snapshot = snap.Snapshot(snapshot)
+    pl.annotateFile(shard, stages, shard + '.annot', snapshot=snapshot,
+        concurrent=concurrent, cache=cache, inflight=inflight)
+    if snapshot:
+        snapshot.close()
+    metrics = [s.metrics for s in stages]
+    if (cache is not None):
+        stages.append(cache)
+    return ([s.counts for s in stages], metrics)
+
+
+"""Worker: annotateShard() for shard i, returning (i, its result)
+"""
+def annotateShardAt(args):
+    (i, shardArgs) = args
+    return (i, annotateShard(shardArgs))
+
+
+"""Annotates infile into outfile with the given stages using a pool of
+worker processes (all cores by default); the counters of the shards
+are summed into stages and written to infile.count.log, and their
+metrics merged into the stages' metrics as each shard is done. outfile
+is written as BGZF when compress is set. With format='pileup' infile is
+a pileup, split into shards of the VCF it converts to.
+
+The shards are annotated with the stages that driver.stages(engine)
+returns; snapshot is a snapshot directory path, opened by each worker.
+Each worker opens its own connection to the variant cache, if any.
+
+With a checkpoint, one is saved as each shard is done, with its
+counters; a saved checkpoint is resumed from by splitting the input
+the same way and annotating only the shards not yet done. When a shard
+fails, the shards still running are stopped and the shard files
+removed, but for the results of the shards done with a checkpoint.
+"""
+def runSharded(infile, stages, outfile, engine='sweep', workers=None,
+    shardsize=None, snapshot=None, concurrent=False, cache=None,
+    inflight=None, compress=False, checkpoint=None, format='vcf'):
+    workers = workers or multiprocessing.cpu_count()
+    state = checkpoint.load() if (checkpoint is not None) else None
+    done = {}
+    if ((state is not None) and (state['step'] == 'parallel')):
+        shardsize = state['shardsize']
+        done = state['done']
+    if (shardsize is None):
+        # a few shards per worker evens out chromosomes of unequal size
+        records = vio.recordestimate(infile, format=format)
+        shardsize = max(1000, records // (workers * 4) + 1)
+
+    shards = split(infile, shardsize, format=format)
+    # shards done before are not annotated again, but count in the log
+    results = [done[str(i)] for i in range(len(shards))
+        if (str(i) in done) and os.path.exists(shards[i] + '.annot')]
+    pending = [i for i in range(len(shards))
+        if (str(i) not in done) or not os.path.exists(shards[i] + '.annot')]
+
+    pool = multiprocessing.Pool(processes=min(workers, max(len(pending), 1)))
+    failed = True
+    try:
+        for (i, result) in pool.imap_unordered(annotateShardAt,
+            [(i, (shards[i], engine, snapshot, concurrent, cache, inflight))
+                for i in pending],
+            chunksize=1):
+            results.append(result[0])
+            for (stage, m) in zip(stages, result[1]):
+                stage.metrics.merge(m)
+            if (checkpoint is not None):
+                done[str(i)] = result[0]
+                checkpoint.save({'step': 'parallel', 'shardsize': shardsize,
+                    'done': done}, files=[shards[i] + '.annot'])
+        pool.close()
+
+        fh_out = vio.openOutput(outfile, compress=compress)
+        for shard in shards:
+            fh = open(shard + '.annot')
+            for line in fh:
+                fh_out.write(line)
+            fh.close()
+        fh_out.close()
+        failed = False
+    except BaseException:
+        # the other shards are of no use now
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for i in range(len(shards)):
+            fu.delete(shards[i])
+            # a checkpoint resumes from the shards done
+            if ((not failed) or (checkpoint is None) or
+                (str(i) not in done)):
+                fu.delete(shards[i] + '.annot')
+
+    counted = stages + ([cache] if (cache is not None) else [])
+    for counts in results:
+        for (stage, c) in zip(counted, counts):
+            for key in c:
+                stage.count(key, c[key])
+
+    pl.writeSummaries(infile + '.count.log', counted)
+
+### EOF
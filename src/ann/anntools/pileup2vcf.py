@@ -7,33 +7,34 @@
 # Modified code copyright (C) 2011-2019 Vas Vasiliadis
 # University of Chicago
 #
+# Usage: python pileup2vcf.py <pileup[.gz]> [<out.vcf>] [workers]
+#
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
+import sys
 import datetime
+import multiprocessing
 import file_utils as fu
+import vcfio as vio
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED = frozenset(ACCEPTED_CHR)
+
+"""Bytes of a plain pileup converted by each worker at a time
+"""
+CHUNK_SIZE = 1 << 24
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
+"""Reads in bases that do not match the reference: the depth less the
+reference matches ('.' and ',') and deletions ('*')
+"""
 def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
-
-    for l in lst:
-        l = str(l)
-
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
-
-    return (int(depth) - (match_sum + ast))
+    return (int(depth) -
+        (bases.count('.') + bases.count(',') + bases.count('*')))
 
 
 def vcfheader(pileup):
@@ -58,63 +59,113 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    alt_x = HETERO.get(alt)
+    if (alt_x is None):
         return alt
-    else:
-        alt_x = HETERO[alt]
-        if (str(ref) == str(alt_x)[0]):
-            return str(alt_x)[1]
-        else:
-            return str(alt_x)[0]
+    if (ref == alt_x[0]):
+        return alt_x[1]
+    return alt_x[0]
 
 
 def varpileup_line2vcf_line(pileupfields):
     """ Converts Variant Pileup format to VCF format """
 
-    t = '\t'
-    chr = str(pileupfields[0])
-    pos = str(pileupfields[1])
-    ref = str(pileupfields[2])
-    alt = str(pileupfields[3])
-    consqual = str(pileupfields[4])
-    snpqual = str(pileupfields[5])
-    mapqual = str(pileupfields[6])
-    depth = str(pileupfields[7])
-    alt_count = str(count_alt(depth, pileupfields[8]))
+    (chr, pos, ref, alt, consqual, snpqual, mapqual, depth, bases) = \
+        pileupfields[:9]
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if (alt in HETERO):
         GT = '0/1'
-        alt = hetero2homo(ref,alt)
+        alt = hetero2homo(ref, alt)
+
+    return '\t'.join([chr, pos, '.', ref, alt, mapqual, 'PASS', '.',
+        'GT:GQ:DP:AD', GT + ':' + consqual + ':' + depth + ':' +
+        str(count_alt(depth, bases))])
+
 
-    return chr + t + pos + t + '.' + t + ref + t + alt + t + mapqual + \
-        t + 'PASS' + t + '.' + t + 'GT:GQ:DP:AD' + t + GT + ':' + \
-        consqual + ':' + depth + ':' + alt_count
+"""VCF lines converted from pileup lines, skipping lines where ALT==REF
+and chromosomes other than 1 - 22, X, Y and MT
+"""
+def convertLines(lines, chr_col=0, ref_col=2, alt_col=3, sep='\t'):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split(sep)
+        if ((fields[alt_col] != fields[ref_col]) and
+            (fields[chr_col].strip() in ACCEPTED)):
+            yield varpileup_line2vcf_line(fields) + '\n'
 
 
+"""Worker: the VCF lines converted from the pileup lines that start in
+bytes [start, end) of a plain pileup file, as one string
+"""
+def convertRange(args):
+    (pileup, start, end, chr_col, ref_col, alt_col, sep) = args
+    fh = open(pileup, 'rb')
+    if (start > 0):
+        # the line running into this range belongs to the one before
+        fh.seek(start - 1)
+        fh.readline()
+    data = b''
+    if (fh.tell() < end):
+        data = fh.read(end - fh.tell())
+        if not data.endswith(b'\n'):
+            data = data + fh.readline()
+    fh.close()
+    return ''.join(convertLines(data.decode().split('\n'), chr_col=chr_col,
+        ref_col=ref_col, alt_col=alt_col, sep=sep))
+
+
+"""VCF lines, header first, converted from a plain or compressed pileup
+file as it is read; the input adapter behind driver.run(format='pileup')
+(see vcfio.openInput)
+"""
+def vcfLines(pileup, sep='\t'):
+    fh = vio.openInput(pileup)
+    try:
+        # x.pileup.gz names its sample as x.pileup does
+        for line in vcfheader(vio.splitExtension(pileup)[0]).split('\n'):
+            yield line + '\n'
+        yield from convertLines(fh, sep=sep)
+    finally:
+        fh.close()
+
+
+"""Converts a pileup file (plain or compressed) to a VCF file, by
+default pileup.vcf
+
+With workers > 1 a plain pileup is converted in chunks of chunksize
+bytes by a pool of that many processes; the chunks are written in
+input order, so the output is the same.
+"""
 def filter_pileup(pileup, outfile=None, chr_col=0, 
-    ref_col=2, alt_col=3, sep='\t'):
+    ref_col=2, alt_col=3, sep='\t', workers=1, chunksize=CHUNK_SIZE):
     
-    fh = open(pileup, "r")
     if (outfile is None):
         outfile = pileup + '.vcf'
 
     fu.delete(outfile)
     fh_out = open(outfile, "w")
-    fh_out.write(vcfheader(pileup) + '\n')
-
-
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
-
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
-
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    fh_out.write(vcfheader(vio.splitExtension(pileup)[0]) + '\n')
+
+    if ((workers or 1) > 1) and not vio.isCompressed(pileup):
+        size = os.path.getsize(pileup)
+        ranges = [(pileup, start, min(start + chunksize, size), chr_col,
+            ref_col, alt_col, sep) for start in range(0, size, chunksize)]
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            for text in pool.imap(convertRange, ranges):
+                fh_out.write(text)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fh = vio.openInput(pileup)
+        fh_out.writelines(convertLines(fh, chr_col=chr_col, ref_col=ref_col,
+            alt_col=alt_col, sep=sep))
+        fh.close()
+    fh_out.close()
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
@@ -141,8 +192,15 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 ref = str(fields[ref_col])
                 alt = str(fields[alt_col])
 
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                if ((alt != ref) and (chr.strip() in ACCEPTED)):
                     fh_out.write(str(line) + '\n')
 
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("Usage: python pileup2vcf.py <pileup[.gz]> [<out.vcf>] [workers]")
+        sys.exit(1)
+    filter_pileup(sys.argv[1], outfile=(sys.argv[2:3] or [None])[0],
+        workers=int((sys.argv[3:4] or [multiprocessing.cpu_count()])[0]))
+
 ### EOF
\ No newline at end of file
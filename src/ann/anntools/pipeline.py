@@ -0,0 +1,253 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Single-pass annotation pipeline: every record is parsed once and
+# handed through all annotation stages in memory
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import itertools
+import os
+from concurrent import futures
+
+import annotate as ann
+import inflight as il
+import utils as u
+import vcfio as vio
+
+
+"""Runs a block of records through all stages, one stage at a time;
+lookups found in the cache (see varcache.py) are not repeated
+
+lookups(stage, records) looks up the records in a stage and returns
+the results in the same order, by default one after the other. The
+time spent on each stage is added to its metrics.
+"""
+def annotateBlock(block, stages, cache=None, lookups=None):
+    lookups = lookups or lookupEach
+    (keys, found) = cachedLookups(block, stages, cache)
+    looked = [{} for record in block]
+    for i, stage in enumerate(stages):
+        with stage.metrics.timer(records=len(block)):
+            id = stage.cacheId()
+            missing = [j for j in range(len(block)) if id not in found[j]]
+            stage.prefetch([block[j] for j in missing])
+            results = dict(zip(missing, 
+                lookups(stage, [block[j] for j in missing])))
+            for (j, record) in enumerate(block):
+                if (i > 0):
+                    record.restrip()
+                if j in results:
+                    result = results[j]
+                    looked[j][id] = stage.cacheResult(result)
+                else:
+                    result = found[j][id]
+                stage.apply(record, result)
+
+    if (cache is not None):
+        cache.put(keys, found, looked)
+
+
+def lookupEach(stage, records):
+    return [stage.lookup(record) for record in records]
+
+
+"""Cache keys and cached lookups of each record in a block
+"""
+def cachedLookups(block, stages, cache):
+    if (cache is None):
+        return (None, [{}] * len(block))
+    return cache.get(block, [stage.cacheId() for stage in stages])
+
+
+"""Indices of the earlier stages that stages[i] requires (see
+annotate.Stage.requires)
+"""
+def dependencies(stages):
+    deps = []
+    for (i, stage) in enumerate(stages):
+        deps.append(set([j for j in range(i)
+            if isinstance(stages[j], tuple(stage.requires))]))
+    return deps
+
+
+"""Looks up a block of records in one stage; the records are copies of
+the columns the lookups read, taken when the lookup is submitted
+"""
+def lookupBlock(stage, records, lookups=None):
+    with stage.metrics.timer():
+        stage.prefetch(records)
+        return (lookups or lookupEach)(stage, records)
+
+
+"""Runs a block of records through all stages with the lookups of
+independent stages running concurrently on executor
+
+The results are applied one stage at a time in stage order, so the
+records come out exactly as from annotateBlock(). A stage is looked up
+as soon as the stages it requires have been applied to the block.
+"""
+def annotateBlockConcurrently(block, stages, executor, deps=None,
+    cache=None, lookups=None):
+    deps = deps or dependencies(stages)
+    (keys, found) = cachedLookups(block, stages, cache)
+    looked = [{} for record in block]
+    ids = [stage.cacheId() for stage in stages]
+    missing = [[j for j in range(len(block)) if ids[i] not in found[j]]
+        for i in range(len(stages))]
+
+    pending = {}
+    for (i, stage) in enumerate(stages):
+        if (len(deps[i]) == 0):
+            pending[i] = executor.submit(lookupBlock, stage,
+                [block[j].copy() for j in missing[i]], lookups)
+
+    for (i, stage) in enumerate(stages):
+        results = dict(zip(missing[i], pending.pop(i).result()))
+        with stage.metrics.timer(records=len(block)):
+            for (j, record) in enumerate(block):
+                if (i > 0):
+                    record.restrip()
+                if j in results:
+                    looked[j][ids[i]] = stage.cacheResult(results[j])
+                    stage.apply(record, results[j])
+                else:
+                    stage.apply(record, found[j][ids[i]])
+
+        for k in range(i + 1, len(stages)):
+            if ((k not in pending) and (max(deps[k] or [-1]) == i)):
+                pending[k] = executor.submit(lookupBlock, stages[k],
+                    [block[j].copy() for j in missing[k]], lookups)
+
+    if (cache is not None):
+        cache.put(keys, found, looked)
+
+
+"""Annotates vcf with all stages in a single pass and writes outfile;
+the stage summaries are written to vcf.count.log in stage order. With
+a snapshot (see snapshot.py) no database connection is opened; with a
+cache (see varcache.py) its hit rate is added to the summaries.
+"""
+def runStream(vcf, stages, outfile, sep='\t', snapshot=None,
+    concurrent=False, cache=None, inflight=None, compress=False,
+    checkpoint=None, format='vcf'):
+    annotateFile(vcf, stages, outfile, sep=sep, snapshot=snapshot,
+        concurrent=concurrent, cache=cache, inflight=inflight,
+        compress=compress, checkpoint=checkpoint, format=format)
+    writeSummaries(vcf + '.count.log', 
+        stages + ([cache] if (cache is not None) else []))
+
+
+"""Annotates vcf with all stages and writes outfile, leaving the
+counters in the stages
+
+With concurrent=True the lookups of independent stages run in parallel
+threads, each stage on its own database connection. With inflight > 1
+up to that many lookups of a stage are kept in flight at once (see
+inflight.py); results are still applied in input order.
+
+vcf may be gzip or BGZF compressed, or a pileup read as VCF with
+format='pileup'; outfile is written as BGZF when compress is set (see
+vcfio.py).
+
+With a checkpoint (see checkpoint.py) the lines done, the size of
+outfile and the stage counters are saved every checkpoint interval; a
+saved checkpoint is resumed from by truncating outfile to that size
+and skipping the lines already annotated.
+"""
+def annotateFile(vcf, stages, outfile, sep='\t', snapshot=None,
+    concurrent=False, cache=None, inflight=None, compress=False,
+    checkpoint=None, format='vcf'):
+    conn = None
+    conns = []
+    opened = []
+    executor = None
+    lookups = None
+    fh = None
+    fh_out = None
+    failed = True
+    try:
+        for stage in stages:
+            if ((snapshot is None) and (concurrent or (conn is None))):
+                conn = u.db_pool().get()
+                conns.append(conn)
+            stage.open(conn, snapshot=snapshot)
+            opened.append(stage)
+
+        deps = dependencies(stages)
+        if concurrent:
+            executor = futures.ThreadPoolExecutor(max_workers=len(stages))
+
+        if ((snapshot is None) and inflight and (inflight > 1)):
+            lookups = il.InflightLookups(inflight=inflight)
+
+        counted = stages + ([cache] if (cache is not None) else [])
+        state = checkpoint.load() if (checkpoint is not None) else None
+        lines = 0
+        if ((state is not None) and (state['step'] == 'stream')):
+            lines = state['lines']
+            for (stage, counts) in zip(counted, state['counts']):
+                stage.counts = counts
+            os.truncate(outfile, state['bytes'])
+
+        fh = vio.openInput(vcf, format=format)
+        fh_out = vio.openOutput(outfile, compress=compress,
+            append=(lines > 0))
+
+        size = max([stage.batch for stage in stages])
+        for item in ann.readBlocks(itertools.islice(fh, lines, None),
+            sep=sep, size=size):
+            if isinstance(item, str):
+                fh_out.write(item + '\n')
+                lines = lines + 1
+            else:
+                if (executor is not None):
+                    annotateBlockConcurrently(item, stages, executor, deps,
+                        cache=cache, lookups=lookups)
+                else:
+                    annotateBlock(item, stages, cache=cache, lookups=lookups)
+                for record in item:
+                    fh_out.write(record.toLine() + '\n')
+                lines = lines + len(item)
+
+            if ((checkpoint is not None) and checkpoint.due()):
+                vio.sync(fh_out)
+                checkpoint.save({'step': 'stream', 'lines': lines,
+                    'bytes': os.path.getsize(outfile),
+                    'counts': [s.counts for s in counted]},
+                    appended=[outfile])
+        failed = False
+    finally:
+        if (fh is not None):
+            fh.close()
+        if (fh_out is not None):
+            fh_out.close()
+        if (executor is not None):
+            executor.shutdown()
+        if (lookups is not None):
+            lookups.close()
+        if (cache is not None):
+            cache.close()
+        for stage in opened:
+            stage.close()
+        # after a failure a connection may be left mid-query
+        for conn in conns:
+            if failed:
+                u.db_pool().discard(conn)
+            else:
+                u.db_pool().put(conn)
+
+
+"""Writes the .count.log file for a completed run
+"""
+def writeSummaries(logcountfile, stages):
+    mode = 'w'
+    for stage in stages:
+        if (len(stage.summary()) > 0):
+            ann.writeSummary(stage, logcountfile, mode=mode)
+            mode = 'a'
+
+### EOF
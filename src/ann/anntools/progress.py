@@ -0,0 +1,113 @@
+# progress.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Live progress of an annotation job: the records each stage has done,
+# read from the stage metrics (see metrics.py) at most once per interval
+# and handed to a reporting function, e.g. one updating the job's
+# DynamoDB item (see run.py)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import threading
+import time
+
+"""Seconds between progress reports; set ANNTOOLS_PROGRESS_SECONDS to
+change it
+"""
+PROGRESS_SECONDS = float(os.environ.get('ANNTOOLS_PROGRESS_SECONDS', 5))
+
+
+"""Reports the progress of a run to report(progress) every interval
+seconds from a background thread, and once more when the run stops, so
+that the cost of reporting does not grow with the input
+
+progress is a dict: the records done by each stage out of the
+variants in the input, the current stage, the records done and to do
+over all stages, the percentage done, the estimated seconds remaining
+(None until a record is done) and the time of the report. A report
+that raises is skipped; the run goes on.
+
+The number of variants given to start() may be an estimate (see
+vcfio.recordestimate); it is raised when a stage goes past it, and
+made exact by stop() when the run is done.
+"""
+class Progress(object):
+    def __init__(self, report, interval=PROGRESS_SECONDS):
+        self.report = report
+        self.interval = interval
+        self.labelled = []
+        self.total = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    """Starts reporting on labelled, the (label, stage) pairs of a run
+    over about total records
+    """
+    def start(self, labelled, total):
+        self.labelled = labelled
+        self.total = total
+        self.started = time.time()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.send()
+
+    """Stops reporting, after a last report; call it however the run ends.
+    When it is done, every stage has gone over every record, so the
+    records they did are the total.
+    """
+    def stop(self, done=True):
+        if (self.thread is None):
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if done:
+            self.total = max([s.metrics.records
+                for (label, s) in self.labelled] + [0])
+        self.send()
+
+    def send(self):
+        try:
+            self.report(self.snapshot())
+        except Exception as e:
+            print(f"Progress report failed: {e}", file=sys.stderr)
+
+    def snapshot(self):
+        stages = [{'label': label, 'records': s.metrics.records}
+            for (label, s) in self.labelled]
+        self.total = max([self.total] + [s['records'] for s in stages])
+        # every stage goes over every record, whichever the mode
+        work = self.total * len(stages)
+        done = sum(s['records'] for s in stages)
+        # the first stage behind the one before it: the one a block of
+        # records is in (stream) or the one running (chain); else the
+        # first with records to do
+        behind = [s['label'] for (s, previous) in zip(stages[1:], stages)
+            if (s['records'] < previous['records'])]
+        todo = [s['label'] for s in stages if (s['records'] < self.total)]
+        current = (behind + todo + [None])[0]
+        now = time.time()
+        remaining = None
+        if (done > 0):
+            remaining = int((now - self.started) * (work - done) / done)
+        return {
+            'stage': current,
+            'stages': stages,
+            'variants': self.total,
+            'records': done,
+            'total': work,
+            'percent': round(100.0 * done / work, 1) if (work > 0) else 100.0,
+            'remaining': remaining,
+            'updated': int(now),
+        }
+
+### EOF
@@ -0,0 +1,383 @@
+# refdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reference database backends: the annotator MySQL database on RDS, or
+# a local SQLite file with the same tables, loaded from table dumps
+#
+# ANNTOOLS_DB selects the backend: 'mysql' (the default) or the path of
+# a SQLite database, built from table dumps with
+#
+# Usage: python refdb.py load <annotator.db> <dump_dir> [table ...]
+#
+# <dump_dir> holds <table>.sql (the CREATE TABLE statement) and
+# <table>.txt or <table>.txt.gz (tab-separated rows) per table, as
+# downloaded from the UCSC database dumps or written by mysqldump --tab.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import os
+import re
+import glob
+import gzip
+import sqlite3
+import threading
+import urllib.request
+
+import utils as u
+
+
+"""Reference tables and the (chromosome, start, end) columns they are
+searched by; a row matches pos when start <= pos <= end
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+}
+for c in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+    TABLES['tfbsConsSites' + c] = ('chrom', 'chromStart', 'chromEnd')
+
+"""Tables split by chromosome, queried without a chromosome condition
+"""
+PER_CHROMOSOME = ('tfbsConsSites',)
+
+"""Rows inserted per statement when loading
+"""
+LOAD_BATCH = 50000
+
+"""Bytes of a SQLite database file memory-mapped by each connection
+"""
+SQLITE_MMAP_SIZE = 1 << 30
+
+
+"""The annotator database on RDS, with the connection parameters from
+AWS Secrets Manager (see utils.db_secret)
+"""
+class MySQLBackend(object):
+    name = 'mysql'
+
+    def __init__(self):
+        import pymysql
+        self.pymysql = pymysql
+        self.errors = (pymysql.err.Error,)
+
+    def connect(self):
+        rds_secret = u.db_secret()
+        return self.pymysql.connect(
+            host=rds_secret['host'],
+            port=rds_secret['port'],
+            user=rds_secret['username'],
+            passwd=rds_secret['password'],
+            db='annotator')
+
+    """Cursor fetching the rows from the server as they are read
+    """
+    def streamCursor(self, conn):
+        return conn.cursor(self.pymysql.cursors.SSCursor)
+
+    """The server does not tell when the tables were last loaded
+    """
+    def version(self):
+        return None
+
+
+"""A SQLite file with the annotator tables (see load()), opened read
+only; any number of threads and processes may read it at once
+"""
+class SQLiteBackend(object):
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Reference database not found: {path}")
+        self.path = os.path.abspath(path)
+
+    def connect(self):
+        return SQLiteConnection(self.path)
+
+    """SQLite cursors already step through the rows as they are read
+    """
+    def streamCursor(self, conn):
+        return conn.cursor()
+
+    """Version of the reference data: the database file is rewritten
+    by each load()
+    """
+    def version(self):
+        stat = os.stat(self.path)
+        return 'sqlite:' + str(stat.st_mtime_ns) + ':' + str(stat.st_size)
+
+
+"""Read-only SQLite connection with the parts of the pymysql
+connection interface that the connection pool uses
+"""
+class SQLiteConnection(object):
+    def __init__(self, path):
+        uri = 'file:' + urllib.request.pathname2url(path) + '?mode=ro'
+        # pooled connections are handed from thread to thread, but only
+        # used by one thread at a time
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.conn.execute('PRAGMA mmap_size=' + str(SQLITE_MMAP_SIZE) + ';')
+        self.open = True
+
+    def cursor(self, *args):
+        return self.conn.cursor()
+
+    def ping(self, reconnect=True):
+        self.conn.execute('select 1;')
+
+    def close(self):
+        self.open = False
+        self.conn.close()
+
+
+_backend = None
+_lock = threading.Lock()
+
+"""The backend selected by ANNTOOLS_DB: 'mysql' (the default) or the
+path of a SQLite database
+"""
+def backend():
+    global _backend
+    source = os.environ.get('ANNTOOLS_DB', 'mysql')
+    with _lock:
+        if ((_backend is None) or (_backend.source != source)):
+            if (source == 'mysql'):
+                _backend = MySQLBackend()
+            else:
+                _backend = SQLiteBackend(source)
+            _backend.source = source
+        return _backend
+
+
+"""Builds the SQLite database dbpath from the table dumps in dumpdir,
+all of them or the named tables; existing tables are replaced
+"""
+def load(dbpath, dumpdir, tables=None):
+    conn = sqlite3.connect(dbpath)
+    conn.execute('PRAGMA journal_mode=OFF;')
+    conn.execute('PRAGMA synchronous=OFF;')
+
+    names = tables or sorted(os.path.basename(f)[:-len('.sql')]
+        for f in glob.glob(os.path.join(dumpdir, '*.sql')))
+    for table in names:
+        print(f"Loading {table} . . .")
+        loadTable(conn, dumpdir, table)
+
+    conn.execute('ANALYZE;')
+    conn.commit()
+    conn.close()
+
+
+def loadTable(conn, dumpdir, table):
+    fh = open(os.path.join(dumpdir, table + '.sql'))
+    (name, columns, keys) = parseSchema(fh.read())
+    fh.close()
+
+    data = dataFile(dumpdir, table)
+    if (data is None):
+        print(f"No data for {table}, skipped")
+        return
+
+    conn.execute('drop table if exists ' + name + ';')
+    conn.execute('create table ' + name + ' (' + ', '.join(
+        [c + ' ' + sqliteType(t) for (c, t) in columns]) + ');')
+
+    blobs = [i for (i, (c, t)) in enumerate(columns) if ('blob' in t)]
+    sql = 'insert into ' + name + ' values (' + \
+        ', '.join(['?'] * len(columns)) + ');'
+    batch = []
+    for row in readRows(data):
+        for i in blobs:
+            if (row[i] is not None):
+                row[i] = row[i].encode('utf-8')
+        batch.append(row)
+        if (len(batch) >= LOAD_BATCH):
+            conn.executemany(sql, batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+
+    for (i, (unique, cols)) in enumerate(keys + rangeKeys(name, keys)):
+        conn.execute('create ' + ('unique ' if unique else '') + 'index ' +
+            name + '_' + str(i) + ' on ' + name + ' (' + ', '.join(cols) +
+            ');')
+    conn.commit()
+
+
+"""The rows file of table in dumpdir, plain or gzip compressed, or None
+"""
+def dataFile(dumpdir, table):
+    for ext in ['.txt', '.txt.gz']:
+        path = os.path.join(dumpdir, table + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+"""Composite index on the columns table is searched by (see TABLES),
+unless one of the dump's own keys starts with them
+"""
+def rangeKeys(table, keys):
+    if (table not in TABLES):
+        return []
+    (chromName, startName, endName) = TABLES[table]
+    cols = [chromName, startName]
+    if table.startswith(PER_CHROMOSOME):
+        cols = [startName]
+    if (endName != startName):
+        cols.append(endName)
+
+    for (unique, k) in keys:
+        if ([c.lower() for c in k[:len(cols)]] == [c.lower() for c in cols]):
+            return []
+    return [(False, cols)]
+
+
+"""Table name, [(column, MySQL type)] and [(unique, [column, ...])]
+keys of a MySQL CREATE TABLE statement
+"""
+def parseSchema(text):
+    m = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?\s*\(',
+        text, re.I)
+    if (m is None):
+        raise ValueError("No CREATE TABLE statement found")
+    name = m.group(1)
+    body = text[m.end():closingParen(text, m.end())]
+
+    columns = []
+    keys = []
+    for d in splitTopLevel(body):
+        d = d.strip()
+        upper = d.upper()
+        if upper.startswith(('PRIMARY KEY', 'UNIQUE', 'KEY', 'INDEX')):
+            inner = d[d.index('(') + 1:d.rindex(')')]
+            cols = re.findall(r'`?(\w+)`?(?:\s*\(\d+\))?(?:\s+(?:ASC|DESC))?',
+                inner, re.I)
+            keys.append((upper.startswith(('PRIMARY', 'UNIQUE')), cols))
+        elif upper.startswith(('CONSTRAINT', 'FOREIGN', 'FULLTEXT', 'SPATIAL',
+            'CHECK')):
+            continue
+        elif d:
+            c = re.match(r'`?(\w+)`?\s+(\w+)', d)
+            columns.append((c.group(1), c.group(2).lower()))
+    return (name, columns, keys)
+
+
+"""Index of the parenthesis closing the one just before text[start]
+"""
+def closingParen(text, start):
+    depth = 1
+    quote = None
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if (ch == quote):
+                quote = None
+        elif (ch in '\'"`'):
+            quote = ch
+        elif (ch == '('):
+            depth = depth + 1
+        elif (ch == ')'):
+            depth = depth - 1
+            if (depth == 0):
+                return i
+    raise ValueError("Unbalanced CREATE TABLE statement")
+
+
+"""Splits a column list at the commas outside parentheses and quotes
+"""
+def splitTopLevel(body):
+    parts = []
+    depth = 0
+    quote = None
+    last = 0
+    for (i, ch) in enumerate(body):
+        if quote:
+            if (ch == quote):
+                quote = None
+        elif (ch in '\'"`'):
+            quote = ch
+        elif (ch == '('):
+            depth = depth + 1
+        elif (ch == ')'):
+            depth = depth - 1
+        elif ((ch == ',') and (depth == 0)):
+            parts.append(body[last:i])
+            last = i + 1
+    parts.append(body[last:])
+    return parts
+
+
+"""SQLite column type for a MySQL one. Text compares case-insensitively,
+as with MySQL's default collations.
+"""
+def sqliteType(mysqlType):
+    if ('int' in mysqlType):
+        return 'INTEGER'
+    if (mysqlType in ['float', 'double', 'real', 'decimal', 'numeric']):
+        return 'REAL'
+    if ('blob' in mysqlType) or ('binary' in mysqlType):
+        return 'BLOB'
+    return 'TEXT COLLATE NOCASE'
+
+
+UNESCAPE = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+    'Z': '\x1a'}
+
+"""Rows of a tab-separated dump as lists of fields, with MySQL's
+backslash escapes undone and \\N read as NULL
+"""
+def readRows(path):
+    fh = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    pending = b''
+    for line in fh:
+        line = pending + line
+        # a line break inside a field is escaped with a backslash
+        body = line.rstrip(b'\n')
+        if ((len(body) - len(body.rstrip(b'\\'))) % 2 == 1):
+            pending = line
+            continue
+        pending = b''
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            text = body.decode('latin-1')
+        yield [unescape(f) for f in text.split('\t')]
+    fh.close()
+
+
+def unescape(field):
+    if (field == '\\N'):
+        return None
+    if ('\\' not in field):
+        return field
+    return re.sub(r'\\(.)', lambda m: UNESCAPE.get(m.group(1), m.group(1)),
+        field, flags=re.S)
+
+
+if __name__ == '__main__':
+    if ((len(sys.argv) < 4) or (sys.argv[1] != 'load')):
+        print("Usage: python refdb.py load <annotator.db> <dump_dir> [table ...]")
+        sys.exit(1)
+    load(sys.argv[2], sys.argv[3], tables=sys.argv[4:])
+
+### EOF
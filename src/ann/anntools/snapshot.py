@@ -0,0 +1,310 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped columnar snapshot of the reference tables, so that the
+# annotation stages can run without the reference database
+#
+# Layout of a snapshot directory:
+#   <table>/columns.json        column names and types, chromosome list
+#   <table>/<chrom>.start.npy   int32 interval starts, sorted
+#   <table>/<chrom>.end.npy     int32 interval ends
+#   <table>/<chrom>.maxend.npy  int32 interval tree annotation
+#   <table>/<chrom>.offsets.npy int64 offsets of the rows in the payload
+#   <table>/<chrom>.order.npy   int64 position of each row in the table
+#   <table>/<chrom>.rows        UTF-8 rows, tab separated
+#
+# Usage: python snapshot.py export <snapshot_dir> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import os
+import json
+import mmap
+import decimal
+from array import array
+
+import numpy as np
+
+import utils as u
+import refdb as rdb
+from intervals import SortedIntervals, tableStream
+
+
+"""Reference tables and the (chromosome, start, end) columns they are
+searched by, see refdb.TABLES
+"""
+TABLES = rdb.TABLES
+
+INT32_MIN = -2147483648
+INT32_MAX = 2147483647
+
+NULL = '\\N'
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+UNESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r'}
+
+
+"""Column values are written as text and restored to the type the
+database returned
+"""
+def kindOf(value):
+    if isinstance(value, bool):
+        return 'int'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, decimal.Decimal):
+        return 'decimal'
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    return 'str'
+
+
+def encode(value):
+    if (value is None):
+        return NULL
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value).decode('latin-1')
+    value = str(value)
+    for c in ESCAPES:
+        if c in value:
+            value = ''.join([ESCAPES.get(x, x) for x in value])
+            break
+    return value
+
+
+def decode(text, kind):
+    if (text == NULL):
+        return None
+    if '\\' in text:
+        chars = []
+        i = 0
+        while (i < len(text)):
+            if ((text[i] == '\\') and (i + 1 < len(text))):
+                chars.append(UNESCAPES.get(text[i + 1], text[i + 1]))
+                i = i + 2
+            else:
+                chars.append(text[i])
+                i = i + 1
+        text = ''.join(chars)
+
+    if (kind == 'int'):
+        return int(text)
+    if (kind == 'float'):
+        return float(text)
+    if (kind == 'decimal'):
+        return decimal.Decimal(text)
+    if (kind == 'bytes'):
+        return text.encode('latin-1')
+    return text
+
+
+"""Exports the given tables (all of TABLES by default) from the
+reference database into the snapshot directory outdir
+"""
+def export(outdir, tables=None):
+    for table in (tables or sorted(TABLES)):
+        print(f"Exporting {table} . . .")
+        exportTable(outdir, table)
+
+
+def exportTable(outdir, table):
+    (chromName, startName, endName) = TABLES[table]
+    path = os.path.join(outdir, table)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('select * from ' + table + ' limit 1;')
+    cursor.fetchall()
+    columns = [d[0] for d in cursor.description]
+    cursor.execute('select distinct ' + chromName + ' from ' + table +
+        ' order by ' + chromName + ';')
+    chroms = [str(r[0]) for r in cursor.fetchall()]
+
+    kinds = [None] * len(columns)
+
+    # rows in start order, numbered in table order as a sweep reads them
+    for chr in chroms:
+        writer = ChromWriter(path, chr)
+        for (start, end, row, order) in tableStream(table, chr,
+            chromName=chromName, startName=startName, endName=endName,
+            conn=conn):
+            for i in range(len(row)):
+                if ((kinds[i] is None) and (row[i] is not None)):
+                    kinds[i] = kindOf(row[i])
+            writer.write(start, end, row, order)
+        writer.close()
+    conn.close()
+
+    fh = open(os.path.join(path, 'columns.json'), 'w')
+    json.dump({'table': table, 'chromName': chromName,
+        'startName': startName, 'endName': endName, 'columns': columns,
+        'kinds': [k or 'str' for k in kinds], 'chroms': chroms}, fh,
+        indent=2)
+    fh.close()
+
+
+"""Writes the files of one chromosome of a table; rows must arrive in
+start order
+"""
+class ChromWriter(object):
+    def __init__(self, path, chr):
+        self.prefix = os.path.join(path, chr)
+        self.chr = chr
+        self.starts = array('i')
+        self.ends = array('i')
+        self.offsets = array('q', [0])
+        self.orders = array('q')
+        self.fh = open(self.prefix + '.rows', 'wb')
+
+    def write(self, start, end, row, order):
+        if not ((INT32_MIN <= start <= INT32_MAX) and
+            (INT32_MIN <= end <= INT32_MAX)):
+            raise ValueError(f"{self.chr}:{start}-{end} does not fit in int32")
+        if ((len(self.starts) > 0) and (start < self.starts[-1])):
+            raise ValueError(f"{self.chr}: rows are not sorted by start")
+
+        data = ('\t'.join([encode(x) for x in row]) + '\n').encode('utf-8')
+        self.fh.write(data)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.orders.append(order)
+
+    def close(self):
+        self.fh.close()
+        tree = SortedIntervals(self.starts, self.ends)
+        np.save(self.prefix + '.start.npy', np.array(self.starts, dtype=np.int32))
+        np.save(self.prefix + '.end.npy', np.array(self.ends, dtype=np.int32))
+        np.save(self.prefix + '.maxend.npy',
+            np.array(tree.maxends, dtype=np.int32))
+        np.save(self.prefix + '.offsets.npy',
+            np.array(self.offsets, dtype=np.int64))
+        np.save(self.prefix + '.order.npy',
+            np.array(self.orders, dtype=np.int64))
+
+
+"""Read-only view of a snapshot directory
+
+Tables and chromosomes are opened on first use. All files are memory
+mapped, so processes reading the same snapshot share one copy in the
+page cache and only the pages actually searched are read from disk.
+"""
+class Snapshot(object):
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            raise IOError(f"No snapshot at {path}")
+        self.path = path
+        self.tables = {}
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = SnapshotTable(os.path.join(self.path, name))
+        return self.tables[name]
+
+    def close(self):
+        for name in self.tables:
+            self.tables[name].close()
+        self.tables = {}
+
+
+class SnapshotTable(object):
+    def __init__(self, path):
+        fh = open(os.path.join(path, 'columns.json'))
+        meta = json.load(fh)
+        fh.close()
+        self.path = path
+        self.name = meta['table']
+        self.columns = meta['columns']
+        self.kinds = meta['kinds']
+        self.chroms = meta['chroms']
+        self.loaded = {}
+
+    """Index of a column in the rows returned by find()
+    """
+    def column(self, name):
+        return self.columns.index(name)
+
+    def chrom(self, chr):
+        chr = str(chr)
+        if chr not in self.loaded:
+            self.loaded[chr] = None
+            if chr in self.chroms:
+                self.loaded[chr] = SnapshotChrom(
+                    os.path.join(self.path, chr), self.kinds)
+        return self.loaded[chr]
+
+    """Rows of chromosome chr overlapping lo..hi (or containing lo), as
+    tuples of all table columns in table order, so the first is the row
+    a query would have returned first
+    """
+    def find(self, chr, lo, hi=None):
+        c = self.chrom(chr)
+        if (c is None):
+            return []
+        return c.find(lo, hi)
+
+    """Rows of any chromosome overlapping lo..hi
+    """
+    def findAll(self, lo, hi=None):
+        rows = []
+        for chr in self.chroms:
+            rows.extend(self.find(chr, lo, hi))
+        return rows
+
+    def close(self):
+        for chr in self.loaded:
+            if (self.loaded[chr] is not None):
+                self.loaded[chr].close()
+        self.loaded = {}
+
+
+class SnapshotChrom(SortedIntervals):
+    def __init__(self, prefix, kinds):
+        self.kinds = kinds
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        # snapshots exported before rows were numbered keep start order
+        self.order = None
+        if os.path.exists(prefix + '.order.npy'):
+            self.order = np.load(prefix + '.order.npy', mmap_mode='r')
+        self.fh = open(prefix + '.rows', 'rb')
+        self.payload = b''
+        if (self.offsets[-1] > 0):
+            self.payload = mmap.mmap(self.fh.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        SortedIntervals.__init__(self,
+            np.load(prefix + '.start.npy', mmap_mode='r'),
+            np.load(prefix + '.end.npy', mmap_mode='r'),
+            np.load(prefix + '.maxend.npy', mmap_mode='r'))
+
+    def find(self, lo, hi=None):
+        hits = self.search(lo, hi)
+        if ((self.order is not None) and (len(hits) > 1)):
+            hits.sort(key=lambda i: self.order[i])
+        return [self.row(i) for i in hits]
+
+    def row(self, i):
+        data = self.payload[int(self.offsets[i]):int(self.offsets[i + 1]) - 1]
+        values = data.decode('utf-8').split('\t')
+        return tuple([decode(values[j], self.kinds[j])
+            for j in range(len(values))])
+
+    def close(self):
+        if isinstance(self.payload, mmap.mmap):
+            self.payload.close()
+        self.fh.close()
+
+
+if __name__ == '__main__':
+    if ((len(sys.argv) < 3) or (sys.argv[1] != 'export')):
+        print("Usage: python snapshot.py export <snapshot_dir> [table ...]")
+        sys.exit(1)
+    export(sys.argv[2], tables=sys.argv[3:])
+
+### EOF
@@ -0,0 +1,270 @@
+# synthvcf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Synthetic VCF generator for scale testing: writes any number of
+# variants and samples, modelled on the records of the data/*.vcf files
+#
+# Usage: python synthvcf.py <out.vcf[.gz]> --variants N --samples N
+#     [--chromosomes genome|data|<chrom>=<weight>,...] [--sortedness F]
+#     [--dbsnp-rate F] [--dbsnp-sites <vcf>] [--seed N]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import argparse
+import bisect
+import glob
+import heapq
+import itertools
+import os
+import random
+
+import vcfio as vio
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+"""GRCh37 chromosome lengths, in the data files' naming
+"""
+GENOME = [
+    ('1', 249250621), ('2', 243199373), ('3', 198022430),
+    ('4', 191154276), ('5', 180915260), ('6', 171115067),
+    ('7', 159138663), ('8', 146364022), ('9', 141213431),
+    ('10', 135534747), ('11', 135006516), ('12', 133851895),
+    ('13', 115169878), ('14', 107349540), ('15', 102531392),
+    ('16', 90354753), ('17', 81195210), ('18', 78077248),
+    ('19', 59128983), ('20', 63025520), ('21', 48129895),
+    ('22', 51304566), ('X', 155270560), ('Y', 59373566), ('MT', 16569),
+]
+
+"""Records a record is moved back by at most in an unsorted output
+"""
+WINDOW = 10000
+
+
+"""Structure of the template VCFs: header lines, the INFO/QUAL/FILTER
+of records at dbSNP sites (with an rs ID) and elsewhere, the sample
+FORMATs with the values seen for each, the chromosome counts and the
+dbSNP sites themselves
+"""
+class Templates(object):
+    def __init__(self, paths, sites=None):
+        self.meta = []
+        self.known = []
+        self.novel = []
+        self.formats = []
+        self.values = {}
+        self.chroms = {}
+        self.sites = {}
+        for path in paths:
+            self.read(path)
+        if sites:
+            self.sites = {}
+            self.readSites(sites)
+        for chr in self.sites:
+            self.sites[chr].sort()
+
+    def read(self, path):
+        fh = vio.openInput(path)
+        for line in fh:
+            if line.startswith('##'):
+                if (line not in self.meta) and \
+                    not line.startswith('##fileformat'):
+                    self.meta.append(line)
+                continue
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            (chr, pos, id, ref, alt) = fields[:5]
+            self.chroms[chr] = self.chroms.get(chr, 0) + 1
+            # QUAL, FILTER, INFO and the allele lengths
+            template = (fields[5], fields[6], fields[7], ref, alt)
+            if id.startswith('rs'):
+                self.known.append(template)
+                self.sites.setdefault(chr, []).append((int(pos), id, ref, alt))
+            else:
+                self.novel.append(template)
+            if (len(fields) > 9):
+                format = fields[8]
+                if (format not in self.values):
+                    self.values[format] = []
+                self.formats.append(format)
+                self.values[format].extend(fields[9:])
+        fh.close()
+
+    """Known sites from a dbSNP VCF (or any VCF with rs IDs)
+    """
+    def readSites(self, path):
+        fh = vio.openInput(path)
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t', 5)
+            if fields[2].startswith('rs'):
+                self.sites.setdefault(fields[0], []).append(
+                    (int(fields[1]), fields[2], fields[3], fields[4]))
+        fh.close()
+
+
+"""Chromosome weights: 'genome' by chromosome length, 'data' as in the
+template files, or an explicit '<chrom>=<weight>,...' list
+"""
+def distribution(spec, templates):
+    if (spec == 'genome'):
+        return [(chr, length) for (chr, length) in GENOME if (chr != 'MT')]
+    if (spec == 'data'):
+        return [(chr, templates.chroms[chr]) for (chr, length) in GENOME
+            if (chr in templates.chroms)]
+    weights = []
+    for part in spec.split(','):
+        (chr, weight) = part.split('=')
+        weights.append((chr, float(weight)))
+    return weights
+
+
+"""Splits count variants over the chromosomes in proportion to their
+weights, in genome order
+"""
+def allocate(count, weights):
+    total = sum(w for (chr, w) in weights)
+    counts = [int(count * w / total) for (chr, w) in weights]
+    # the rounding remainder goes to the largest shares
+    order = sorted(range(len(weights)), key=lambda i: -weights[i][1])
+    for i in order[:count - sum(counts)]:
+        counts[i] = counts[i] + 1
+    return [(chr, n) for ((chr, w), n) in zip(weights, counts)]
+
+
+"""count sorted positions drawn uniformly from 1..length, generated one
+at a time (successive uniform order statistics)
+"""
+def positions(rng, count, length):
+    u = 0.0
+    last = 0
+    for i in range(count):
+        u = 1.0 - (1.0 - u) * (rng.random() ** (1.0 / (count - i)))
+        pos = max(int(u * length) + 1, last + 1)
+        last = pos
+        yield pos
+
+
+"""The records of one chromosome in position order: known dbSNP sites
+for about rate of them and novel positions for the rest; a record is
+(pos, id, ref, alt, template)
+"""
+def chromRecords(rng, templates, chr, count, length, rate):
+    sites = templates.sites.get(chr, [])
+    known = min(int(round(count * rate)), len(sites))
+    picked = sorted(rng.sample(range(len(sites)), known))
+    knownRecords = ((sites[i][0], sites[i][1], sites[i][2], sites[i][3],
+        rng.choice(templates.known or templates.novel)) for i in picked)
+
+    length = max(length, sites[-1][0] if sites else 0)
+    novelRecords = (novel(rng, templates, pos)
+        for pos in positions(rng, count - known, length))
+    return heapq.merge(knownRecords, novelRecords, key=lambda r: r[0])
+
+
+BASES = 'ACGT'
+
+"""A record at a position that is not a known site, with the allele
+lengths of a template record
+"""
+def novel(rng, templates, pos):
+    template = rng.choice(templates.novel or templates.known)
+    ref = ''.join(rng.choice(BASES) for i in range(len(template[3])))
+    alt = rng.choice([b for b in BASES if (b != ref[0])]) + \
+        ''.join(rng.choice(BASES) for i in range(len(template[4].split(',')[0]) - 1))
+    return (pos, '.', ref, alt, template)
+
+
+"""Passes the records through in order when sortedness is 1; otherwise
+each record is held back with probability 1 - sortedness and written
+up to WINDOW records later
+"""
+def shuffle(rng, records, sortedness):
+    held = []
+    for (i, r) in enumerate(records):
+        while held and (held[0][0] <= i):
+            yield heapq.heappop(held)[2]
+        if (rng.random() < sortedness):
+            yield r
+        else:
+            heapq.heappush(held, (i + rng.randint(1, WINDOW), i, r))
+    while held:
+        yield heapq.heappop(held)[2]
+
+
+"""Writes a VCF of variants records and samples sample columns to path
+(BGZF compressed if it ends in .gz or .bgz); see the usage above
+"""
+def generate(path, variants, samples=0, chromosomes='genome', sortedness=1.0,
+    rate=0.5, sites=None, seed=None, templates=None):
+    rng = random.Random(seed)
+    templates = templates or Templates(sorted(glob.glob(
+        os.path.join(DATA_DIR, '*.vcf'))), sites=sites)
+    formats = list(templates.values)
+    if samples and not formats:
+        raise ValueError("The template files have no sample columns")
+    # cumulative format weights, by the number of records using each
+    weights = list(itertools.accumulate(templates.formats.count(f)
+        for f in formats))
+
+    lengths = dict(GENOME)
+    fh = vio.openOutput(path, compress=(len(vio.splitExtension(path)[1]) > 0))
+    fh.write('##fileformat=VCFv4.1\n')
+    fh.writelines(templates.meta)
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+    if samples:
+        columns = columns + ['FORMAT'] + \
+            ['SAMPLE' + str(i + 1) for i in range(samples)]
+    fh.write('\t'.join(columns) + '\n')
+
+    records = itertools.chain.from_iterable(
+        ((chr, r) for r in chromRecords(rng, templates, chr, n,
+            lengths.get(chr, 1000000), rate))
+        for (chr, n) in allocate(variants, distribution(chromosomes, templates)))
+    for (chr, (pos, id, ref, alt, template)) in shuffle(rng, records,
+        sortedness):
+        (qual, filter, info) = template[:3]
+        line = chr + '\t' + str(pos) + '\t' + id + '\t' + ref + '\t' + \
+            alt + '\t' + qual + '\t' + filter + '\t' + info
+        if samples:
+            format = formats[bisect.bisect(weights,
+                rng.random() * weights[-1])]
+            line = line + '\t' + format + '\t' + \
+                '\t'.join(rng.choices(templates.values[format], k=samples))
+        fh.write(line + '\n')
+    fh.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic VCF modelled on the data VCFs')
+    parser.add_argument('output', help='VCF file (.gz or .bgz: BGZF)')
+    parser.add_argument('--variants', type=int, default=100000,
+        help='number of records (default 100000)')
+    parser.add_argument('--samples', type=int, default=0,
+        help='number of sample columns (default 0)')
+    parser.add_argument('--chromosomes', default='genome',
+        help="'genome' (by length, the default), 'data' (as in the data "
+            "VCFs) or <chrom>=<weight>,...")
+    parser.add_argument('--sortedness', type=float, default=1.0,
+        help='fraction of records left in position order (default 1)')
+    parser.add_argument('--dbsnp-rate', type=float, default=0.5,
+        help='fraction of records at known dbSNP sites (default 0.5)')
+    parser.add_argument('--dbsnp-sites',
+        help='VCF of known sites; by default the rs IDs of the data VCFs')
+    parser.add_argument('--seed', type=int, help='random seed')
+    args = parser.parse_args()
+
+    generate(args.output, args.variants, samples=args.samples,
+        chromosomes=args.chromosomes, sortedness=args.sortedness,
+        rate=args.dbsnp_rate, sites=args.dbsnp_sites, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,431 @@
+# tabix.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Coordinate-sorted BGZF results with a tabix (.tbi) index, and a reader
+# fetching only the blocks that cover a region, from a local file or
+# through S3 byte-range requests
+#
+# Usage: python tabix.py index <annotated.vcf> <result.vcf.gz>
+#        python tabix.py fetch <result.vcf.gz> <chrom>[:<start>-<end>]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import os
+import gzip
+import heapq
+import struct
+import tempfile
+import zlib
+
+import annotate as ann
+import vcfio as vio
+
+"""Linear index window, 16 kb
+"""
+LINEAR_SHIFT = 14
+
+"""Largest position the binning scheme covers (2^29)
+"""
+MAX_POS = 1 << 29
+
+"""Pseudo-bin holding the offsets and record count of a chromosome
+"""
+META_BIN = 37450
+
+"""Records sorted in memory at a time; larger inputs are merged from
+sorted runs written to temporary files
+"""
+RUN_SIZE = 1000000
+
+"""Compressed bytes fetched per read while fetching a region
+"""
+READ_SIZE = 4 * 1024 * 1024
+
+
+"""Bin of the smallest binning-scheme interval holding beg..end (0-based,
+end exclusive), as in the UCSC binning scheme used by BAM and tabix
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    for (shift, offset) in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        if ((beg >> shift) == (end >> shift)):
+            return offset + (beg >> shift)
+    return 0
+
+
+"""Bins that may hold intervals overlapping beg..end
+"""
+def reg2bins(beg, end):
+    end = min(end, MAX_POS) - 1
+    bins = [0]
+    for (shift, offset) in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+"""0-based start and exclusive end of a VCF record, from POS and the
+length of REF (as tabix -p vcf does without an END tag)
+"""
+def recordSpan(fields):
+    beg = int(fields[1]) - 1
+    ref = fields[3] if (len(fields) > 3) else ''
+    return (beg, beg + max(len(ref.strip()), 1))
+
+
+"""Sorts the annotated VCF src by chromosome and position into the BGZF
+file dst and writes its index to dst.tbi
+
+Chromosomes keep the order they first appear in, and records at the
+same position keep their input order, so a sorted input is copied
+unchanged. Header lines are written first.
+"""
+def sortAndIndex(src, dst, sep='\t'):
+    headers = []
+    ranks = {}
+    runs = []
+    run = []
+
+    def key(line):
+        fields = line.split(sep, 2)
+        return (ranks[fields[0]], int(fields[1]))
+
+    fh = vio.openInput(src)
+    for line in fh:
+        if ann.isHeader(line):
+            headers.append(line)
+            continue
+        chr = line.split(sep, 1)[0]
+        if chr not in ranks:
+            ranks[chr] = len(ranks)
+        run.append(line.rstrip('\n') + '\n')
+        if (len(run) >= RUN_SIZE):
+            runs.append(writeRun(sorted(run, key=key)))
+            run = []
+    fh.close()
+
+    run.sort(key=key)
+    if (len(runs) == 0):
+        records = run
+    else:
+        runs.append(writeRun(run))
+        records = heapq.merge(*[open(r) for r in runs], key=key)
+
+    fh_out = vio.BgzfWriter(dst)
+    fh_out.writelines(headers)
+    index = TabixIndex()
+    for line in records:
+        start = fh_out.tell()
+        fh_out.write(line)
+        fields = line.split(sep, 4)
+        (beg, end) = recordSpan(fields)
+        index.add(fields[0], beg, end, start, fh_out.tell())
+    fh_out.close()
+    index.write(dst + '.tbi')
+
+    for r in runs:
+        os.unlink(r)
+
+
+def writeRun(lines):
+    (fd, path) = tempfile.mkstemp(suffix='.run')
+    fh = os.fdopen(fd, 'w')
+    fh.writelines(lines)
+    fh.close()
+    return path
+
+
+"""Binned and linear index of a BGZF VCF, built from records added in
+sorted order, as described in the tabix paper (Heng Li, 2011)
+"""
+class TabixIndex(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+
+    def add(self, chr, beg, end, start, stop):
+        if chr not in self.refs:
+            self.names.append(chr)
+            self.refs[chr] = {'bins': {}, 'linear': [], 'first': start,
+                'last': stop, 'n': 0}
+        ref = self.refs[chr]
+        ref['last'] = stop
+        ref['n'] = ref['n'] + 1
+
+        chunks = ref['bins'].setdefault(reg2bin(beg, end), [])
+        if ((len(chunks) > 0) and (chunks[-1][1] == start)):
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        linear = ref['linear']
+        last = (max(end, beg + 1) - 1) >> LINEAR_SHIFT
+        while (len(linear) <= last):
+            linear.append(None)
+        for w in range((beg >> LINEAR_SHIFT), last + 1):
+            if (linear[w] is None):
+                linear[w] = start
+
+    """Writes the index in the tabix format, BGZF compressed
+    """
+    def write(self, path):
+        names = b''.join([n.encode('utf-8') + b'\0' for n in self.names])
+        # VCF: sequence in column 1, position in column 2, '#' comments
+        data = [b'TBI\1', struct.pack('<8i', len(self.names), 2, 1, 2, 0,
+            ord('#'), 0, len(names)), names]
+        for name in self.names:
+            ref = self.refs[name]
+            bins = ref['bins']
+            data.append(struct.pack('<i', len(bins) + 1))
+            for bin in sorted(bins):
+                data.append(struct.pack('<Ii', bin, len(bins[bin])))
+                for (start, stop) in bins[bin]:
+                    data.append(struct.pack('<QQ', start, stop))
+            data.append(struct.pack('<Ii', META_BIN, 2))
+            data.append(struct.pack('<QQQQ', ref['first'], ref['last'],
+                ref['n'], 0))
+
+            linear = fillLinear(ref['linear'])
+            data.append(struct.pack('<i', len(linear)))
+            data.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+        data.append(struct.pack('<Q', 0))
+
+        fh = vio.BgzfWriter(path)
+        fh.writeBytes(b''.join(data))
+        fh.close()
+
+
+"""Windows without an entry take the offset of the window before them,
+leading ones that of the first record
+"""
+def fillLinear(linear):
+    filled = []
+    last = next((x for x in linear if (x is not None)), 0)
+    for x in linear:
+        if (x is not None):
+            last = x
+        filled.append(last)
+    return filled
+
+
+"""Reads a tabix index from its (BGZF compressed) bytes; returns the
+chromosome names and, by name, a (bins, linear) pair
+"""
+def parseIndex(data):
+    data = gzip.decompress(data)
+    if (data[:4] != b'TBI\1'):
+        raise ValueError("Not a tabix index")
+    (n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm) = \
+        struct.unpack_from('<8i', data, 4)
+    p = 36
+    names = [n.decode('utf-8') for n in data[p:p + l_nm].split(b'\0')[:n_ref]]
+    p = p + l_nm
+
+    refs = {}
+    for name in names:
+        bins = {}
+        (n_bin,) = struct.unpack_from('<i', data, p)
+        p = p + 4
+        for i in range(n_bin):
+            (bin, n_chunk) = struct.unpack_from('<Ii', data, p)
+            p = p + 8
+            chunks = struct.unpack_from('<' + str(2 * n_chunk) + 'Q', data, p)
+            p = p + 16 * n_chunk
+            if (bin != META_BIN):
+                bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from('<i', data, p)
+        p = p + 4
+        linear = struct.unpack_from('<' + str(n_intv) + 'Q', data, p)
+        p = p + 8 * n_intv
+        refs[name] = (bins, linear)
+    return (names, refs)
+
+
+"""Byte ranges of a local file
+"""
+class FileSource(object):
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+
+    def read(self, offset, size):
+        self.fh.seek(offset)
+        return self.fh.read(size)
+
+    def readAll(self, suffix=''):
+        fh = open(self.fh.name + suffix, 'rb')
+        data = fh.read()
+        fh.close()
+        return data
+
+    def close(self):
+        self.fh.close()
+
+
+"""Byte ranges of an S3 object, one ranged GET per read
+"""
+class S3Source(object):
+    def __init__(self, bucket, key, s3=None, region_name=None):
+        if (s3 is None):
+            import boto3
+            s3 = boto3.client('s3', region_name=region_name)
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.requests = 0
+
+    def read(self, offset, size):
+        self.requests = self.requests + 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+            Range='bytes=' + str(offset) + '-' + str(offset + size - 1))
+        return response['Body'].read()
+
+    def readAll(self, suffix=''):
+        self.requests = self.requests + 1
+        response = self.s3.get_object(Bucket=self.bucket,
+            Key=self.key + suffix)
+        return response['Body'].read()
+
+    def close(self):
+        pass
+
+
+"""Region queries on a BGZF VCF with a tabix index
+
+source reads byte ranges of the compressed file (FileSource,
+S3Source); the index is read from the same place with a .tbi suffix
+unless its bytes are given. Only the blocks holding records that may
+overlap the region are read, in ranges of up to READ_SIZE bytes.
+"""
+class TabixReader(object):
+    def __init__(self, source, index=None, sep='\t'):
+        self.source = source
+        self.sep = sep
+        (self.names, self.refs) = parseIndex(index or source.readAll('.tbi'))
+
+    """Records (lines without the newline) of chromosome chr overlapping
+    start..end, 1-based and inclusive like a tabix region; the whole
+    chromosome by default
+    """
+    def fetch(self, chr, start=None, end=None):
+        if chr not in self.refs:
+            return
+        beg = max((start or 1) - 1, 0)
+        end = min(end or MAX_POS, MAX_POS)
+        for line in self.lines(self.chunks(chr, beg, end)):
+            fields = line.split(self.sep, 4)
+            if (fields[0] != chr):
+                continue
+            (b, e) = recordSpan(fields)
+            if (b >= end):
+                return
+            if (e > beg):
+                yield line
+
+    """Merged (start, stop) virtual offset ranges that may hold records
+    overlapping beg..end (0-based, end exclusive)
+    """
+    def chunks(self, chr, beg, end):
+        (bins, linear) = self.refs[chr]
+        minimum = 0
+        if (len(linear) > 0):
+            minimum = linear[min(beg >> LINEAR_SHIFT, len(linear) - 1)]
+
+        chunks = sorted([c for b in reg2bins(beg, end) if b in bins
+            for c in bins[b] if (c[1] > minimum)])
+        merged = []
+        for (start, stop) in chunks:
+            start = max(start, minimum)
+            if ((len(merged) > 0) and (start >> 16 <= merged[-1][1] >> 16)):
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+    """Lines held in the virtual offset ranges, in file order
+    """
+    def lines(self, chunks):
+        for (start, stop) in chunks:
+            pending = b''
+            for (offset, block) in self.blocks(start >> 16, stop >> 16):
+                if (offset == (stop >> 16)):
+                    block = block[:stop & 0xffff]
+                if (offset == (start >> 16)):
+                    block = block[start & 0xffff:]
+                parts = (pending + block).split(b'\n')
+                pending = parts.pop()
+                for part in parts:
+                    yield part.decode('utf-8')
+            if (len(pending) > 0):
+                yield pending.decode('utf-8')
+
+    """Decompressed BGZF blocks starting at file offsets first..last, as
+    (offset, data)
+    """
+    def blocks(self, first, last):
+        offset = first
+        data = b''
+        p = 0
+        while (offset <= last):
+            bsize = None
+            if (len(data) - p >= 18):
+                bsize = struct.unpack_from('<H', data, p + 16)[0] + 1
+            if ((bsize is None) or (len(data) - p < bsize)):
+                data = data[p:]
+                p = 0
+                # the last block is at most 64 KB long
+                more = self.source.read(offset + len(data),
+                    min(READ_SIZE, last + 65536 - offset - len(data)))
+                if (len(more) == 0):
+                    return
+                data = data + more
+                continue
+            yield (offset, zlib.decompress(data[p + 18:p + bsize - 8], -15))
+            p = p + bsize
+            offset = offset + bsize
+
+    def close(self):
+        self.source.close()
+
+
+"""Reader of a local BGZF VCF indexed as path.tbi
+"""
+def openFile(path):
+    return TabixReader(FileSource(path))
+
+
+"""Reader of a BGZF VCF in S3 indexed as key.tbi
+"""
+def openS3(bucket, key, s3=None, region_name=None):
+    return TabixReader(S3Source(bucket, key, s3=s3, region_name=region_name))
+
+
+"""Parses chr, chr:start or chr:start-end
+"""
+def parseRegion(region):
+    if (':' not in region):
+        return (region, None, None)
+    (chr, span) = region.rsplit(':', 1)
+    span = span.replace(',', '')
+    if ('-' in span):
+        (start, end) = span.split('-', 1)
+        return (chr, int(start), int(end) if end else None)
+    return (chr, int(span), int(span))
+
+
+if __name__ == '__main__':
+    if ((len(sys.argv) == 4) and (sys.argv[1] == 'index')):
+        sortAndIndex(sys.argv[2], sys.argv[3])
+    elif ((len(sys.argv) == 4) and (sys.argv[1] == 'fetch')):
+        reader = openFile(sys.argv[2])
+        for line in reader.fetch(*parseRegion(sys.argv[3])):
+            print(line)
+        reader.close()
+    else:
+        print("Usage: python tabix.py index <annotated.vcf> <result.vcf.gz>")
+        print("       python tabix.py fetch <result.vcf.gz> <chrom>[:<start>-<end>]")
+        sys.exit(1)
+
+### EOF
@@ -13,39 +13,155 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
-import pymysql
-import boto3
-from botocore.exceptions import ClientError
+import time
+import threading
 
-"""Get connection to reference database
+import refdb as rdb
+
+"""Seconds the RDS secret is cached before it is fetched again; set
+ANNTOOLS_SECRET_TTL to change it
+"""
+SECRET_TTL = int(os.environ.get('ANNTOOLS_SECRET_TTL', 300))
+
+_secret = None
+_secret_time = 0
+_secret_lock = threading.Lock()
+
+"""Get the RDS connection parameters from AWS Secrets Manager, cached
+for SECRET_TTL seconds; the AWS SDK is only needed for this, so it is
+imported here
+"""
+def db_secret():
+    global _secret, _secret_time
+    import boto3
+    from botocore.exceptions import ClientError
+
+    with _secret_lock:
+        if ((_secret is not None) and
+            (time.time() - _secret_time < SECRET_TTL)):
+            return _secret
+
+        AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+            ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+            _secret = json.loads(asm_response['SecretString'])
+            _secret_time = time.time()
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        return _secret
+
+
+"""Get connection to reference database, from the backend selected by
+ANNTOOLS_DB (see refdb.py)
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+    return rdb.backend().connect()
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+
+"""Pool of reusable connections to the reference database
+
+get() hands out an idle connection, checked with a ping, or opens a new
+one; put() returns it for reuse. Connections that went stale (e.g.
+closed by the server after wait_timeout) are reopened transparently.
+At most size idle connections are kept; the pool is thread safe.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=16, connect=None):
+        self.size = size
+        self.connect = connect or db_connect
+        self.idle = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    """After a fork the idle sockets belong to the parent process
+    """
+    def checkFork(self):
+        if (self.pid != os.getpid()):
+            with self.lock:
+                self.idle = []
+                self.pid = os.getpid()
+
+    def get(self):
+        self.checkFork()
+        while True:
+            with self.lock:
+                if (len(self.idle) == 0):
+                    break
+                conn = self.idle.pop()
+            try:
+                conn.ping(reconnect=True)
+                return conn
+            except rdb.backend().errors:
+                self.discard(conn)
+        return self.connect()
+
+    def put(self, conn):
+        self.checkFork()
+        if not conn.open:
+            return
+        with self.lock:
+            if (len(self.idle) < self.size):
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except rdb.backend().errors:
+            pass
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+
+_pool = None
+
+"""Process-wide connection pool that the annotation stages borrow from
+"""
+def db_pool():
+    global _pool
+    with _secret_lock:
+        if (_pool is None):
+            _pool = ConnectionPool(
+                size=int(os.environ.get('ANNTOOLS_POOL_SIZE', 16)))
+    return _pool
+
+
+"""Streams the rows of a query without buffering the whole result set in
+memory, from conn or else a dedicated connection; observe, if given, is
+called with the seconds the query took to start returning rows. conn
+is left open, with no rows pending, for its owner to reuse.
+"""
+def db_stream(sql, observe=None, conn=None):
+    dedicated = (conn is None)
+    if dedicated:
+        conn = db_connect()
+    cursor = None
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+        cursor = rdb.backend().streamCursor(conn)
+        start = time.perf_counter()
+        cursor.execute(sql)
+        if (observe is not None):
+            observe(time.perf_counter() - start)
+        for row in cursor:
+            yield row
+    finally:
+        if dedicated:
+            conn.close()
+        elif (cursor is not None):
+            # reads whatever rows are left
+            cursor.close()
 
 
 """Column inices for pileup and VCF
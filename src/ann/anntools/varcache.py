@@ -0,0 +1,224 @@
+# varcache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Persistent cross-job cache of annotation lookups, keyed by variant and
+# reference data version
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import json
+import base64
+import decimal
+import hashlib
+import sqlite3
+import zlib
+
+import annotate as ann
+import refdb as rdb
+
+
+"""Cache of the stage lookups of each variant, in an SQLite file
+
+An entry holds what every stage's lookup() returned for a variant, as
+trimmed by the stage's cacheResult(), keyed by a hash of (chrom, pos,
+ref, alt, reference data version). Entries are stored as JSON (see
+encode()), never as pickles, since other jobs may write the file.
+Stage lookups only read these columns, so on a hit the stages apply
+the cached results without querying the reference database and the
+record is annotated (and counted) exactly as on a miss.
+
+The least recently used entries are evicted once the stored results
+exceed maxsize bytes. Several processes may share the file.
+"""
+class VariantCache(object):
+    logmode = 'a'
+    echo = False
+
+    def __init__(self, path, refversion, maxsize=1024 * 1024 * 1024,
+        format='vcf'):
+        self.path = path
+        self.refversion = refversion
+        self.maxsize = maxsize
+        self.inds = ann.getFormatSpecificIndices(format=format)
+        self.counts = {}
+        self.conn = None
+
+    def open(self):
+        if (self.conn is not None):
+            return
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        # so that "insert or replace" fires the delete trigger
+        self.conn.execute('PRAGMA recursive_triggers=ON;')
+        self.conn.executescript('''
+            create table if not exists variants (key text primary key,
+                value blob, size integer, used real);
+            create index if not exists variants_used on variants (used);
+            create table if not exists meta (id integer primary key,
+                total integer);
+            insert or ignore into meta values (0, 0);
+            create trigger if not exists variants_insert after insert
+                on variants begin
+                update meta set total = total + new.size where id = 0; end;
+            create trigger if not exists variants_delete after delete
+                on variants begin
+                update meta set total = total - old.size where id = 0; end;
+            ''')
+        self.conn.commit()
+
+    def close(self):
+        if (self.conn is not None):
+            self.conn.close()
+        self.conn = None
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def key(self, record):
+        inds = self.inds
+        chr = record[inds[0]].strip()
+        if chr.startswith('chr'):
+            chr = chr.replace('chr', '')
+        variant = '\t'.join([self.refversion, chr, record[inds[1]].strip(),
+            ann.clean_mysql_chars(record[inds[2]]).strip(),
+            ann.clean_mysql_chars(record[inds[3]]).strip()])
+        return hashlib.sha1(variant.encode('utf-8')).hexdigest()
+
+    """Keys of a block of records and the cached lookups of each record,
+    a dict of results by stage cache id (empty on a miss); a record is
+    counted as a hit when all the stage ids are cached
+    """
+    def get(self, block, ids):
+        self.open()
+        keys = [self.key(record) for record in block]
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            sql = 'select key, value from variants where key in (' + \
+                ','.join(['?'] * len(part)) + ');'
+            for (key, value) in self.conn.execute(sql, part):
+                found[key] = decode(json.loads(zlib.decompress(value)))
+
+        if (len(found) > 0):
+            self.conn.executemany('update variants set used = ? ' +
+                'where key = ?;', [(time.time(), k) for k in found])
+            self.conn.commit()
+
+        results = [found.get(key, {}) for key in keys]
+        for result in results:
+            self.count('variants')
+            if all([(id in result) for id in ids]):
+                self.count('hits')
+        return (keys, results)
+
+    """Stores the lookups of the records that had any stage missing
+    """
+    def put(self, keys, found, looked):
+        entries = {}
+        for (key, old, new) in zip(keys, found, looked):
+            if (len(new) > 0):
+                result = dict(old)
+                result.update(new)
+                try:
+                    value = json.dumps(encode(result), separators=(',', ':'))
+                except TypeError:
+                    # a value JSON cannot hold; the variant is looked up
+                    # again next time
+                    continue
+                entries[key] = zlib.compress(value.encode('utf-8'))
+        if (len(entries) == 0):
+            return
+
+        now = time.time()
+        self.conn.executemany('insert or replace into variants ' +
+            'values (?, ?, ?, ?);',
+            [(k, entries[k], len(entries[k]), now) for k in entries])
+        self.conn.commit()
+        self.evict()
+
+    """Removes the least recently used entries while the cache is larger
+    than maxsize
+    """
+    def evict(self):
+        while True:
+            total = self.conn.execute(
+                'select total from meta where id = 0;').fetchone()[0]
+            if (total <= self.maxsize):
+                return
+            cur = self.conn.execute('delete from variants where key in ' +
+                '(select key from variants order by used limit 100);')
+            self.conn.commit()
+            if (cur.rowcount == 0):
+                return
+
+    def summary(self):
+        variants = self.counts.get('variants', 0)
+        hits = self.counts.get('hits', 0)
+        rate = (hits / float(variants)) * 100 if (variants > 0) else 0.0
+        return [f"Variant cache: {str(hits)} hits in {str(variants)} " + \
+            f"variants ({str(rate)}%)"]
+
+
+"""A lookup result as JSON values: tuples, dicts, bytes and decimals
+are tagged so that decode() gives back the same values
+"""
+def encode(value):
+    if ((value is None) or isinstance(value, (bool, int, float, str))):
+        return value
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, tuple):
+        return {'t': [encode(v) for v in value]}
+    if isinstance(value, dict):
+        return {'m': [[encode(k), encode(v)] for (k, v) in value.items()]}
+    if isinstance(value, (bytes, bytearray)):
+        return {'b': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, decimal.Decimal):
+        return {'d': str(value)}
+    raise TypeError(f"Cannot cache a {type(value).__name__}")
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if ('t' in value):
+        return tuple([decode(v) for v in value['t']])
+    if ('m' in value):
+        return dict([(decode(k), decode(v)) for (k, v) in value['m']])
+    if ('b' in value):
+        return base64.b64decode(value['b'])
+    return decimal.Decimal(value['d'])
+
+
+"""Cache configured by the environment, or None: ANNTOOLS_CACHE is the
+path of the cache file, ANNTOOLS_REFVERSION the reference data version
+and ANNTOOLS_CACHE_SIZE the size limit in bytes
+
+Entries of one reference version are never used with another, so the
+version has to change whenever the reference data does. Without one
+it is taken from a SQLite reference database (see
+refdb.SQLiteBackend.version); annotating from MySQL or a snapshot with
+the cache on requires it to be given.
+"""
+def fromEnvironment(path=None, refversion=None, snapshot=None):
+    path = path or os.environ.get('ANNTOOLS_CACHE')
+    if not path:
+        return None
+    refversion = refversion or os.environ.get('ANNTOOLS_REFVERSION')
+    if (not refversion) and (snapshot is None):
+        refversion = rdb.backend().version()
+    if not refversion:
+        raise ValueError("The variant cache needs the reference data " +
+            "version: set ANNTOOLS_REFVERSION or pass refversion")
+    return VariantCache(path, refversion,
+        maxsize=int(os.environ.get('ANNTOOLS_CACHE_SIZE', 1024 ** 3)))
+
+### EOF
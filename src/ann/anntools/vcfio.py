@@ -0,0 +1,205 @@
+# vcfio.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Plain, gzip and BGZF (blocked gzip, as written by bgzip) VCF files
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import io
+import os
+import struct
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+"""Compressed file name extensions, longest first
+"""
+EXTENSIONS = ['.bgz', '.gz']
+
+"""Uncompressed bytes per BGZF block, as in htslib
+"""
+BLOCK_SIZE = 0xff00
+
+"""Empty block marking the end of a BGZF file
+"""
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b00' +
+    '03000000000000000000')
+
+"""File bytes (compressed bytes, for a compressed file) read by
+recordestimate() before it extrapolates
+"""
+ESTIMATE_BYTES = 1 << 22
+
+
+"""True when the file at path is gzip (or BGZF) compressed
+"""
+def isCompressed(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return (magic == GZIP_MAGIC)
+
+
+"""Splits the compressed extension off a file name: 'x.vcf.gz' gives
+('x.vcf', '.gz') and 'x.vcf' gives ('x.vcf', '')
+"""
+def splitExtension(path):
+    for ext in EXTENSIONS:
+        if path.endswith(ext):
+            return (path[:-len(ext)], ext)
+    return (path, '')
+
+
+"""Opens a VCF file for reading as text, decompressing it on the fly
+if it is gzip or BGZF compressed (whatever its name). With
+format='pileup' the file is a samtools pileup, read as the VCF lines
+it converts to (see pileup2vcf.vcfLines).
+"""
+def openInput(path, format='vcf'):
+    if (format == 'pileup'):
+        import pileup2vcf as p2v
+        return p2v.vcfLines(path)
+    if isCompressed(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""Opens a VCF file for writing as text, BGZF compressed if compress;
+with append=True the text is added to the end of the file
+"""
+def openOutput(path, compress=False, append=False):
+    if compress:
+        return BgzfWriter(path, append=append)
+    return open(path, 'a' if append else 'w')
+
+
+"""Flushes an output file opened by openOutput() to disk; a BGZF file
+then ends with a complete block, and may be reopened for appending
+"""
+def sync(fh):
+    fh.flush()
+    raw = getattr(fh, 'fh', fh)
+    raw.flush()
+    os.fsync(raw.fileno())
+
+
+"""Estimated number of data records (lines that are not header lines)
+in a plain or compressed VCF file, or of VCF records a pileup file
+converts to, without reading the whole file: the records in its first
+sample bytes, scaled by the size of the file. Files up to sample bytes
+are counted exactly.
+"""
+def recordestimate(path, format='vcf', sample=ESTIMATE_BYTES):
+    raw = open(path, 'rb')
+    fh = io.TextIOWrapper(gzip.GzipFile(fileobj=raw)
+        if isCompressed(path) else raw)
+    lines = fh
+    if (format == 'pileup'):
+        import pileup2vcf as p2v
+        lines = p2v.convertLines(fh)
+    n = 0
+    first = None
+    for line in lines:
+        if (line.startswith('#') or line.startswith('CHROM')):
+            continue
+        if (first is None):
+            # the records start here, give or take a read buffer
+            first = raw.tell()
+        n = n + 1
+        if (raw.tell() >= sample):
+            break
+    else:
+        fh.close()
+        return n
+    read = raw.tell()
+    fh.close()
+    size = os.path.getsize(path)
+    if (read <= first):
+        return int(n * size / read)
+    return int(n * (size - first) / (read - first))
+
+
+"""Copies the plain text file src into the BGZF file dst
+"""
+def compressFile(src, dst):
+    fh = open(src)
+    fh_out = BgzfWriter(dst)
+    for line in fh:
+        fh_out.write(line)
+    fh.close()
+    fh_out.close()
+
+
+"""Text file writer producing BGZF: a series of gzip members of at most
+64 KB each, with the block size in the BC extra field, ending with an
+empty member. Any gzip reader decompresses the result.
+
+tell() gives the virtual offset of the next byte written: the file
+offset of its block shifted left by 16, plus its offset in the block.
+"""
+class BgzfWriter(object):
+    def __init__(self, path, level=6, append=False):
+        self.fh = open(path, 'ab' if append else 'wb')
+        self.level = level
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, text):
+        self.writeBytes(text.encode('utf-8'))
+
+    def writeBytes(self, data):
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if (self.buffered >= BLOCK_SIZE):
+            data = b''.join(self.buffer)
+            while (len(data) >= BLOCK_SIZE):
+                self.writeBlock(data[:BLOCK_SIZE])
+                data = data[BLOCK_SIZE:]
+            self.buffer = [data]
+            self.buffered = len(data)
+
+    def tell(self):
+        return (self.fh.tell() << 16) | self.buffered
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if (self.buffered > 0):
+            self.writeBlock(b''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def writeBlock(self, data):
+        cdata = deflate(data, self.level)
+        if (len(cdata) + 26 > 65536):
+            # incompressible; stored blocks always fit
+            cdata = deflate(data, 0)
+        self.fh.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' +
+            struct.pack('<HH', 2, len(cdata) + 25) + cdata +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        self.flush()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Raw deflate stream of data, as held in a gzip member
+"""
+def deflate(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush()
+
+### EOF
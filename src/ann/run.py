@@ -13,10 +13,13 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 sys.path.insert(1, './anntools')
 import driver
+import checkpoint as cp
+import progress as pg
 sys.path.append("../util")
 import helpers
 
-import time, boto3, logging, os, shutil, json
+import time, boto3, logging, os, shutil, json, threading
+from decimal import Decimal
 from botocore.exceptions import ClientError
 from configparser import SafeConfigParser
 from boto3.dynamodb.conditions import Key
@@ -40,37 +43,140 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""Name of the result file for an input .vcf, .vcf.gz or .vcf.bgz file;
+compressed inputs, and indexed results, are compressed (see
+driver.resultFile)
+"""
+def result_file(name, index=False):
+  for ext in ['.vcf.gz', '.vcf.bgz', '.vcf']:
+    if name.endswith(ext):
+      result = name[:-len(ext)] + config['aws']['ResultFilePostfix'] + ext[4:]
+      return (result + '.gz') if (index and (ext == '.vcf')) else result
+  return name[:-4] + config['aws']['ResultFilePostfix']
+
+"""Progress reporter storing the progress of a job in its DynamoDB item
+as job_progress, at most every ProgressSeconds (see progress.py)
+"""
+def job_progress(table, job_id):
+  def report(progress):
+    # DynamoDB takes no floats
+    table.update_item(
+      Key = { 'job_id': job_id },
+      UpdateExpression = 'SET job_progress = :val1',
+      ExpressionAttributeValues = {
+        ':val1': json.loads(json.dumps(progress), parse_float=Decimal)
+      }
+    )
+  return pg.Progress(report,
+    interval=config['aws'].getfloat('ProgressSeconds', fallback=pg.PROGRESS_SECONDS))
+
+"""Keeps the job request message hidden from other annotators while the
+job runs: a background thread extends its visibility timeout to
+JobVisibilityTimeout every third of it. Once the job completes, delete()
+removes the message; if the job or its instance dies first, the message
+reappears and the job is redelivered, resuming from its checkpoint
+"""
+class MessageLease(object):
+  def __init__(self, sqs, receipt_handle):
+    self.sqs = sqs
+    self.receipt_handle = receipt_handle
+    self.timeout = config['aws'].getint('JobVisibilityTimeout', fallback=300)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.loop, daemon=True)
+    self.thread.start()
+
+  def loop(self):
+    while True:
+      try:
+        self.sqs.change_message_visibility(
+          QueueUrl=config['aws']['SQSJobRequestUrl'],
+          ReceiptHandle=self.receipt_handle,
+          VisibilityTimeout=self.timeout)
+      except ClientError as e:
+        logging.error(e)
+      if self.stopped.wait(self.timeout / 3.0):
+        return
+
+  def delete(self):
+    self.stopped.set()
+    self.thread.join()
+    self.sqs.delete_message(
+      QueueUrl=config['aws']['SQSJobRequestUrl'],
+      ReceiptHandle=self.receipt_handle)
+
 if __name__ == '__main__':
 	# Call the AnnTools pipeline
   if len(sys.argv) > 1:
     with Timer():
       filename = sys.argv[1]
-      driver.run(filename, 'vcf')
- 
-      # Upload the results and log files to S3 results bucket
       job_id = sys.argv[2]
       user_email = sys.argv[3]
+      receipt_handle = sys.argv[4] if len(sys.argv) > 4 else None
+      index = config['aws'].getboolean('IndexResults', fallback=False)
+
+      # Checkpoints in the job directory, mirrored to S3 if a bucket is
+      # set, so that a restarted job resumes where it stopped
+      checkpoint = None
+      if config['aws'].getboolean('CheckpointJobs', fallback=False):
+        checkpoint = cp.forFile(filename,
+          bucket=config['aws'].get('AWSS3CheckpointBucket', fallback=None),
+          prefix=config['aws'].get('CheckpointPrefix', fallback='checkpoints') + '/' + job_id,
+          region_name=config['aws']['AwsRegionName'])
 
       # Connect to S3 and Dynamo DB
       S3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
       Dynamo = boto3.resource('dynamodb',region_name=config['aws']['AwsRegionName'])
+      table = Dynamo.Table(config['aws']['DynamoAnnotationsTable'])
+      sqs = boto3.client('sqs',region_name=config['aws']['AwsRegionName'])
+
+      # Hold on to the job request until the job completes
+      lease = None
+      if receipt_handle:
+        lease = MessageLease(sqs, receipt_handle)
+
+      # Live progress in the job item while the job runs
+      progress = None
+      if config['aws'].getboolean('JobProgress', fallback=False):
+        progress = job_progress(table, job_id)
+      driver.run(filename, 'vcf', index=index, checkpoint=checkpoint,
+        progress=progress,
+        refversion=config['aws'].get('ReferenceVersion', fallback=None) or None)
+ 
+      # Upload the results and log files to S3 results bucket
 
       # Retrieve job detail from the Dynamo table
-      table = Dynamo.Table(config['aws']['DynamoAnnotationsTable'])
       response = table.get_item(Key = {'job_id': job_id})
       S3_input_file = response["Item"]["s3_key_input_file"]
-      annotFile = S3_input_file[:-4]+config['aws']['ResultFilePostfix']
+      annotFile = result_file(S3_input_file, index)
+      indexFile = annotFile+config['aws']['IndexFilePostfix']
       logFile = S3_input_file+config['aws']['LogFilePostfix']
+      metricsFile = S3_input_file+config['aws']['MetricsFilePostfix']
 
       # Upload result file and log file
       try:
-        S3.upload_file(filename[:-4]+config['aws']['ResultFilePostfix'],config['aws']['AWSS3ResultBucket'],annotFile)
+        S3.upload_file(result_file(filename, index),config['aws']['AWSS3ResultBucket'],annotFile)
       except ClientError as e:
         logging.error(e)
+      # The index lets region queries read the result by byte ranges
+      if index:
+        try:
+          S3.upload_file(result_file(filename, index)+config['aws']['IndexFilePostfix'],config['aws']['AWSS3ResultBucket'],indexFile)
+        except ClientError as e:
+          logging.error(e)
       try:
         S3.upload_file(filename+config['aws']['LogFilePostfix'],config['aws']['AWSS3ResultBucket'],logFile)
       except ClientError as e:
         logging.error(e)
+      try:
+        S3.upload_file(filename+config['aws']['MetricsFilePostfix'],config['aws']['AWSS3ResultBucket'],metricsFile)
+      except ClientError as e:
+        logging.error(e)
+
+      # Per-stage metrics for the job item; DynamoDB takes no floats
+      metrics = None
+      if config['aws'].getboolean('JobMetrics', fallback=False):
+        with open(filename+config['aws']['MetricsFilePostfix']) as fh:
+          metrics = json.load(fh, parse_float=Decimal)
 
       # Delete local job files
       job_dir = filename[0 : filename.find("/",9)]
@@ -80,24 +186,31 @@ if __name__ == '__main__':
         print("Failed to delete local job directory for job id", job_id)
 
       # Update the job item in my DynamoDB table 
-      response  = table.update_item(
-        Key = { 'job_id': job_id },
-        UpdateExpression = 'SET s3_results_bucket = :val1, \
+      update = 'SET s3_results_bucket = :val1, \
           s3_key_result_file = :val2, \
           s3_key_log_file = :val3, \
           complete_time = :val4, \
-          job_status = :val5',
-        ExpressionAttributeValues = {
+          job_status = :val5'
+      values = {
                 ':val1': config['aws']['AWSS3ResultBucket'],
                 ':val2': annotFile,
                 ':val3': logFile,
                 ':val4': int(time.time()),
                 ':val5': "COMPLETED"
         }
+      if index:
+        update = update + ', s3_key_index_file = :val6'
+        values[':val6'] = indexFile
+      if metrics is not None:
+        update = update + ', stage_metrics = :val7'
+        values[':val7'] = metrics['stages']
+      response  = table.update_item(
+        Key = { 'job_id': job_id },
+        UpdateExpression = update,
+        ExpressionAttributeValues = values
       )
       
       # Publish a message to notify the user that the job is completed
-      sqs = boto3.client('sqs',region_name=config['aws']['AwsRegionName'])
       sqs.send_message(
                 QueueUrl=config['aws']['SQSJobResultsUrl'],
                 MessageBody=json.dumps({
@@ -121,9 +234,13 @@ if __name__ == '__main__':
         )
       else:
         pass
+
+      # The job is done; remove its request from the queue
+      if lease is not None:
+        lease.delete()
   
       
   else:
-    print("A valid .vcf file must be provided as input to this program.")
+    print("A valid .vcf, .vcf.gz or .vcf.bgz file must be provided as input to this program.")
 
 ### EOF
\ No newline at end of file
@@ -81,8 +81,8 @@ def archive():
         try:
             table.update_item(
             Key = { 'job_id': job_id },
-                        UpdateExpression="SET results_file_archive_id = :val1 REMOVE s3_key_result_file",
-                        ExpressionAttributeValues={':val1': archive_id},
+                        UpdateExpression="SET results_file_archive_id = :val1, s3_key_archived_result_file = :val2 REMOVE s3_key_result_file",
+                        ExpressionAttributeValues={':val1': archive_id, ':val2': s3_key_result_file},
                         
                     )
         except Exception as e:
@@ -65,7 +65,7 @@ def thaw():
             query_response = table.query(
                 IndexName = config['aws']['DynamoAnnotationsTableIndex'],
                 Select='SPECIFIC_ATTRIBUTES',
-                ProjectionExpression="job_id,s3_key_input_file",
+                ProjectionExpression="job_id,s3_key_input_file,s3_key_archived_result_file",
                 KeyConditionExpression="results_file_archive_id = :val",
                 ExpressionAttributeValues={
                     ":val": archive_id},
@@ -84,11 +84,17 @@ def thaw():
                 archiveId=archive_id
             )
             continue
-        # Generate key result file name
+        # Generate key result file name; the archiver records it, older
+        # items only have the input key (.vcf, .vcf.gz or .vcf.bgz)
         item = query_response['Items'][0]
         job_id = item['job_id']
         s3_key_input_file = item['s3_key_input_file']
-        s3_key_result_file = s3_key_input_file[:-4]+config['aws']['ResultFilePostfix']
+        s3_key_result_file = item.get('s3_key_archived_result_file')
+        if not s3_key_result_file:
+            s3_key_result_file = s3_key_input_file[:-4]+config['aws']['ResultFilePostfix']
+            for ext in ['.vcf.gz', '.vcf.bgz']:
+                if s3_key_input_file.endswith(ext):
+                    s3_key_result_file = s3_key_input_file[:-len(ext)]+config['aws']['ResultFilePostfix']+ext[4:]
         S3 = boto3.client('s3',region_name=config['aws']['AwsRegionName'])
         # Upload file
         try:
@@ -107,7 +113,7 @@ def thaw():
                 ExpressionAttributeValues={
                     ':val': s3_key_result_file
                 }, 
-                UpdateExpression='SET s3_key_result_file = :val REMOVE results_file_archive_id, restore_message'
+                UpdateExpression='SET s3_key_result_file = :val REMOVE results_file_archive_id, s3_key_archived_result_file, restore_message'
             )
         except exceptions.ClientError as e:
             print('Server Error: ' + f'{e}')
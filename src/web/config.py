@@ -111,6 +111,10 @@ class Config(object):
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "katherinezh@mpcs-cc.com"
 
+  # Time without a progress update before a running job is flagged as
+  # stalled on its details page (in seconds)
+  JOB_PROGRESS_STALE = 300
+
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
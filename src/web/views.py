@@ -21,7 +21,7 @@ import uuid
 import time
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import boto3
 import logging
@@ -158,7 +158,7 @@ def annotations_list():
     IndexName="user_id_index",
     KeyConditionExpression=Key('user_id').eq(session['primary_identity']))
   for item in resp['Items']:
-    item['submit_time'] = strftime('%Y-%m-%d %H:%M', localtime(item['submit_time']))
+    item['submit_time'] = strftime('%Y-%m-%d %H:%M', localtime(int(item['submit_time'])))
     annotations_list.append(item)
   
   return render_template('annotations.html', annotations=annotations_list)
@@ -200,7 +200,14 @@ def annotation_details(id):
     return None
   item['input_file_url'] = input_file_url
   # Convert epoch time to human readable time
-  item['submit_time'] = strftime('%Y-%m-%d %H:%M', localtime(item['submit_time']))
+  item['submit_time'] = strftime('%Y-%m-%d %H:%M', localtime(int(item['submit_time'])))
+  # Show the live progress of a running job, flagging it if updates stopped
+  if (item['job_status'] == "RUNNING") and ('job_progress' in item):
+    progress = item['job_progress']
+    progress['stalled'] = (time.time() - float(progress['updated']) > app.config['JOB_PROGRESS_STALE'])
+    progress['updated'] = strftime('%Y-%m-%d %H:%M:%S', localtime(int(progress['updated'])))
+    if progress.get('remaining') is not None:
+      progress['remaining'] = str(timedelta(seconds=int(progress['remaining'])))
   # If job completed, check if user is eligible to download result file
   if item['job_status'] == "COMPLETED":
     if (session.get('role') == "free_user") and (time.time() - float(item['complete_time']) > 300):
@@ -223,7 +230,7 @@ def annotation_details(id):
         return None
       item['result_file_url'] = result_file_url
     # Convert complete time to human readable
-    item['complete_time'] = strftime('%Y-%m-%d %H:%M', localtime(item['complete_time']))
+    item['complete_time'] = strftime('%Y-%m-%d %H:%M', localtime(int(item['complete_time'])))
     
   
   return render_template('annotation_details.html', annotation=item, free_access_expired=free_access_expired)